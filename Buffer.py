@@ -1,5 +1,6 @@
 # https://scimusing.wordpress.com/2013/10/25/ring-buffers-in-pythonnumpy/
 import numpy as np
+import json
 
 class StaticBuffer:
     def __init__(self, size, dtype=np.float64):
@@ -32,49 +33,247 @@ class StaticBuffer:
         return self[:].tolist()
 
 
+class DiskBuffer(StaticBuffer):
+    '''A StaticBuffer backed by a preallocated np.memmap file instead of RAM, so its size is bounded
+       by the disk. The raw samples go to path and a json header describing them (dtype, number of
+       samples written, plus whatever metadata is passed in) goes to path + '.json'.'''
+    def __init__(self, size, dtype=np.int16, path:str=None, metadata:dict=None):
+        if path is None:
+            raise ValueError('DiskBuffer needs a path!')
+        self.path = path
+        self.metadata = dict(metadata or {})
+        self.dtype = dtype
+        self.data = np.memmap(path, dtype=dtype, mode='w+', shape=(size,))
+        self.index = 0
+        self.full = False
+        self.write_header()
+    def reset(self, **kwargs):
+        temp = dict(size=self.data.size, dtype=self.data.dtype, path=self.path, metadata=self.metadata)
+        temp.update(**kwargs)
+        self.close()
+        self.__init__(**temp)
+    def extend(self, x:np.ndarray):
+        '''Like StaticBuffer.extend, but drops whatever doesn't fit instead of raising, since the 
+           driver can hand back a few more samples than were asked for.'''
+        x = x[:self.data.size-self.index]
+        if x.size:
+            super().extend(x)
+    def write_header(self):
+        header = dict(self.metadata, dtype=np.dtype(self.dtype).str, size=int(self.data.size),
+                      n_samples=int(self.index))
+        with open(self.path + '.json', 'w') as f:
+            json.dump(header, f, indent=4)
+    def flush(self):
+        self.data.flush()
+        self.write_header()
+    def close(self):
+        self.flush()
+        del self.data
+
+
 class RingBuffer(StaticBuffer):
     "A 1D ring buffer using numpy arrays"
     def extend(self, x):
         "Extends ring buffer by array x"
         if len(x) == 0:
             raise ValueError("Can't extend a zero-length object!")
-        elif len(x) > self.data.size:
+        elif len(x) >= self.data.size:
             self.data[:] = x[-self.data.size:]
             self.index = 0
             self.full = True
         else:
-            x_index = (self.index + np.arange(len(x))) % self.data.size
-            self.data[x_index] = x
+            # at most two slice copies: up to the end of the buffer, then the part that wraps around
+            end = self.index + len(x)
+            if end <= self.data.size:
+                self.data[self.index:end] = x
+            else:
+                head = self.data.size - self.index
+                self.data[self.index:] = x[:head]
+                self.data[:end-self.data.size] = x[head:]
 
-            if x_index[-1] < self.index and not self.full:
+            if end >= self.data.size:
                 self.full = True
-            self.index = x_index[-1] + 1
-    def get_data(self):
-        idx = (self.index + np.arange(len(self))) % len(self)
-        return self.data[:idx]
+            self.index = end % self.data.size
+    def get_view(self)->tuple[np.ndarray,np.ndarray]:
+        '''Returns the contents as an (older, newer) pair of slices of data, without copying.
+           Read them in that order to get the samples oldest first.'''
+        if self.full:
+            return self.data[self.index:], self.data[:self.index]
+        return self.data[:0], self.data[:self.index]
+    def get_data(self, out:np.ndarray=None)->np.ndarray:
+        '''Returns the contents oldest first. This is a view when the buffer hasn't wrapped 
+           (or happens to line up), otherwise a single concatenation, written into out if given.'''
+        older, newer = self.get_view()
+        if out is None:
+            if not older.size:
+                return newer
+            if not newer.size:
+                return older
+            return np.concatenate((older, newer))
+        out = out[:older.size+newer.size]
+        out[:older.size] = older
+        out[older.size:] = newer
+        return out
     def tolist(self):
         return self.get_data().tolist()
 
 
 class BinnedRingBuffer(RingBuffer):
     '''Class for making a binned ring buffer. Holds all data, but it
-       only rolls in multiples of the binsize and returns binned data.'''
-    def get_data(self, binsize:int=1)->np.ndarray:
-        '''Bin first, then roll. This ensures that the same samples go into a bin 
-           regardless of where index is, until those samples are overwritten.'''
-        
-        idx = (self.index//binsize + np.arange(len(self)//binsize)) % (len(self)//binsize)
-        if self.full:
-            arr = self.data
+       only rolls in multiples of the binsize and returns binned data.
+       The bin sums of the last few binsizes asked for are cached (accumulated in
+       int64 for integer data, so int16 samples are never promoted to float64 in
+       bulk), and only the bins touched by the samples written since the last
+       get_data are redone.
+       A min/max pyramid (bins of PYRAMID_BASE*PYRAMID_FACTOR**level samples) is
+       kept up to date the same way, for peak-preserving envelopes at any binsize.'''
+    MAX_CACHED_BINSIZES = 8
+    PYRAMID_BASE = 16
+    PYRAMID_FACTOR = 4
+    def __init__(self, size, dtype=np.float64):
+        super().__init__(size, dtype=dtype)
+        self.written = 0 # total samples ever written, to know what changed since a cache was synced
+        self._bin_cache = {} # binsize -> [bin sums, written when synced]
+        self._acc_dtype = np.int64 if np.issubdtype(self.data.dtype, np.integer) else np.float64
+        self._pyramid = [] # [binsize, mins, maxs] per level, finest first
+        binsize = BinnedRingBuffer.PYRAMID_BASE
+        while binsize <= self.data.size:
+            n_bins = self.data.size//binsize
+            self._pyramid.append([binsize, np.zeros(n_bins, dtype=dtype), np.zeros(n_bins, dtype=dtype)])
+            binsize *= BinnedRingBuffer.PYRAMID_FACTOR
+        self._pyramid_synced = -1
+    def extend(self, x):
+        super().extend(x)
+        self.written += len(x)
+    def _dirty_ranges(self, synced:int)->list[tuple[int,int]]:
+        '''(start, stop) ranges of data written since the written count was synced, split where they wrap.'''
+        n_new = self.written - synced
+        if synced < 0 or n_new >= self.data.size:
+            return [(0, self.data.size)]
+        start = (self.index - n_new) % self.data.size
+        if n_new == 0:
+            return []
+        if start + n_new <= self.data.size:
+            return [(start, start+n_new)]
+        return [(start, self.data.size), (0, start+n_new-self.data.size)]
+    def get_new(self, synced:int)->tuple[np.ndarray,...]:
+        '''Views of the samples written since the written count was synced, oldest first (at most
+           the whole buffer, if more than that was written the oldest of them are gone).'''
+        if self.written - synced >= len(self):
+            return self.get_view()
+        return tuple(self.data[start:stop] for start, stop in self._dirty_ranges(synced))
+    @staticmethod
+    def _bin_range(start:int, stop:int, binsize:int, n_bins:int)->tuple[int,int]:
+        '''Every bin overlapping data[start:stop], but there are no bins past n_bins*binsize.'''
+        return start//binsize, min((stop-1)//binsize + 1, n_bins)
+    def _update_bins(self, binsize:int)->np.ndarray:
+        '''Bring the cached bin sums for binsize up to date and return them (all bins, unrolled).'''
+        n_bins = self.data.size//binsize
+        if binsize not in self._bin_cache:
+            if len(self._bin_cache) >= BinnedRingBuffer.MAX_CACHED_BINSIZES:
+                del self._bin_cache[next(iter(self._bin_cache))] # oldest binsize asked for
+            self._bin_cache[binsize] = [np.zeros(n_bins, dtype=self._acc_dtype), -1]
+        sums, synced = self._bin_cache[binsize]
+        for start, stop in self._dirty_ranges(synced):
+            lo, hi = self._bin_range(start, stop, binsize, n_bins)
+            if lo < hi:
+                # one bulk reduction straight into the cache, no float temporaries
+                np.add.reduce(self.data[lo*binsize:hi*binsize].reshape(hi-lo, binsize), axis=1,
+                              dtype=self._acc_dtype, out=sums[lo:hi])
+        self._bin_cache[binsize][1] = self.written
+        return sums
+    @staticmethod
+    def _fold(ufunc:np.ufunc, x:np.ndarray, g:int)->np.ndarray:
+        '''ufunc (np.minimum or np.maximum) over every g consecutive elements of x. Reducing along a 
+           short last axis is slow in numpy, so for small g the columns are combined one at a time.'''
+        rows = x.reshape(-1, g)
+        if g > 16:
+            return ufunc.reduce(rows, axis=1)
+        out = rows[:,0].copy()
+        for k in range(1, g):
+            ufunc(out, rows[:,k], out=out)
+        return out
+    def _update_pyramid(self):
+        '''Redo the finest level from data and every coarser level from the one below it, 
+           but only for the bins touched since the last update.'''
+        F = BinnedRingBuffer.PYRAMID_FACTOR
+        for start, stop in self._dirty_ranges(self._pyramid_synced):
+            lo, hi = start, stop
+            src_min = src_max = self.data
+            src_binsize = 1
+            for binsize, mins, maxs in self._pyramid:
+                g = binsize//src_binsize # children per bin
+                lo, hi = self._bin_range(lo, hi, g, mins.size)
+                if lo >= hi:
+                    break
+                mins[lo:hi] = self._fold(np.minimum, src_min[lo*g:hi*g], g)
+                maxs[lo:hi] = self._fold(np.maximum, src_max[lo*g:hi*g], g)
+                src_min, src_max, src_binsize = mins, maxs, binsize
+        self._pyramid_synced = self.written
+    def _roll_bins(self, bins:np.ndarray, binsize:int, scale:float=None, out:np.ndarray=None)->np.ndarray:
+        '''Roll the (unrolled, bin-aligned) bins so the oldest comes first, multiplying by scale
+           on the way into out (a float64 array, allocated if not given) if scale is given.'''
+        # first datapoint is always going to be weird because its bin will 
+        # include old and new data so throw away that point after binning
+        if not bins.size: # binsize longer than the buffer
+            parts = ()
+        elif self.full:
+            roll = self.index//binsize % bins.size
+            parts = (bins[roll+1:], bins[:roll])
         else:
-            arr = self.data[:self.index]
-
-        if binsize != 1:
-            new_shape = (arr.size//binsize, binsize)
-            # first datapoint is always going to be weird because its bin will 
-            # include old and new data so throw away that point after binning
-            return np.mean(arr[:np.prod(new_shape)].reshape(new_shape), axis=1)[idx][1:]
-        return arr[idx]
+            parts = (bins[1:self.index//binsize],)
+        n = sum(p.size for p in parts)
+        if out is None:
+            out = np.empty(n, dtype=bins.dtype if scale is None else np.float64)
+        out = out[:n]
+        i = 0
+        for p in parts:
+            if scale is None:
+                out[i:i+p.size] = p
+            else:
+                np.multiply(p, scale, out=out[i:i+p.size])
+            i += p.size
+        return out
+    def get_data(self, binsize:int=1, scale:float=1., out:np.ndarray=None)->np.ndarray:
+        '''Bin first, then roll. This ensures that the same samples go into a bin 
+           regardless of where index is, until those samples are overwritten.
+           The bin means are multiplied by scale (e.g. the volts per ADC count) only at the very end,
+           into out if given so that repeated calls don't allocate.'''
+        if binsize == 1:
+            if scale == 1 and out is None:
+                return super().get_data()
+            data = super().get_data()
+            return np.multiply(data, scale, out=None if out is None else out[:data.size])
+        return self._roll_bins(self._update_bins(binsize), binsize, scale/binsize, out)
+    def envelope_binsize(self, binsize:int)->int:
+        '''The smallest binsize >= binsize that is a multiple of the coarsest pyramid level that fits 
+           in it, so get_envelope never has to fall back to a finer level (or the raw data). 
+           This rounds up by less than a factor of 2.'''
+        level_binsize = 1
+        for s, _, _ in self._pyramid:
+            if s <= binsize:
+                level_binsize = s
+        return -(-binsize//level_binsize)*level_binsize
+    def get_envelope(self, binsize:int=1, scale:float=1.)->tuple[np.ndarray,np.ndarray,np.ndarray]:
+        '''Returns (min, max, mean) of every bin, binned and rolled like get_data and multiplied by scale. 
+           The min and max come from the coarsest pyramid level whose binsize divides binsize, so 
+           this costs O(output points) times binsize over that level's binsize, which is small for
+           binsizes rounded with envelope_binsize.'''
+        if binsize == 1:
+            data = self.get_data(1, scale)
+            return data, data, data
+        n_bins = self.data.size//binsize
+        self._update_pyramid()
+        src_min = src_max = self.data
+        src_binsize = 1
+        for level_binsize, mins, maxs in self._pyramid:
+            if binsize % level_binsize == 0:
+                src_min, src_max, src_binsize = mins, maxs, level_binsize
+        g = binsize//src_binsize
+        mins = self._fold(np.minimum, src_min[:n_bins*g], g)
+        maxs = self._fold(np.maximum, src_max[:n_bins*g], g)
+        return (self._roll_bins(mins, binsize, scale), self._roll_bins(maxs, binsize, scale),
+                self.get_data(binsize, scale))
     def tolist(self, binsize:int=1)->list:
         return self.get_data(binsize).tolist()
 
@@ -84,4 +283,32 @@ def ringbuff_numpy_test():
     ringbuff = RingBuffer(ringlen)
     for i in range(40):
         ringbuff.extend(np.ones(10000, dtype=np.float64)) # write
-        ringbuff.get() #read
\ No newline at end of file
+        ringbuff.get_data() #read
+
+def ringbuff_extend_benchmark(chunk_sizes=(1000, 10000, 100000, 1000000),
+                              buffer_sizes=(1000000, 10000000), repeats:int=20):
+    '''Compare the throughput of RingBuffer.extend with the old index-array version it replaced.'''
+    import time
+    def old_extend(buff, x):
+        x_index = (buff.index + np.arange(len(x))) % buff.data.size
+        buff.data[x_index] = x
+        buff.index = x_index[-1] + 1
+    for size in buffer_sizes:
+        for chunk in chunk_sizes:
+            if chunk > size:
+                continue
+            x = np.ones(chunk, dtype=np.int16)
+            res = {}
+            for name,extend in (('old', old_extend), ('new', RingBuffer.extend)):
+                buff = RingBuffer(size, dtype=np.int16)
+                buff.index = size - chunk//2 # make every other chunk wrap around
+                t0 = time.perf_counter()
+                for _ in range(repeats):
+                    extend(buff, x)
+                res[name] = repeats*chunk/(time.perf_counter()-t0)
+            print(f'buffer {size:>9d}, chunk {chunk:>8d}: old {res["old"]/1e6:8.1f} MS/s, '
+                  f'new {res["new"]/1e6:8.1f} MS/s ({res["new"]/res["old"]:.1f}x)')
+
+
+if __name__ == '__main__':
+    ringbuff_extend_benchmark()
@@ -0,0 +1,236 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from Buffer import RingBuffer
+import os, pickle
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+try:
+    import pyfftw, pyfftw.interfaces.numpy_fft
+except ImportError:
+    pyfftw = None
+
+class FFTBackend:
+    '''rfft from whichever library is installed: pyfftw (with its wisdom cached in wisdom_path between
+       runs), scipy.fft, or numpy as the fallback. The first two use several cores. Pass name to force
+       one, and workers to limit how many cores each call may use (default all of them).'''
+    def __init__(self, name:str=None, workers:int=None, wisdom_path:str='fftw_wisdom.pkl'):
+        available = [k for k,lib in (('pyfftw', pyfftw), ('scipy', scipy_fft), ('numpy', np)) if lib is not None]
+        if name is None:
+            name = available[0]
+        elif name not in available:
+            raise ValueError(f'FFT backend {name} is not available. Should be one of {tuple(available)}.')
+        self.name = name
+        self.workers = workers or os.cpu_count() or 1
+        self.wisdom_path = wisdom_path
+        if name == 'pyfftw':
+            pyfftw.interfaces.cache.enable() # keeps the plans (and aligned arrays) of recent calls around
+            if os.path.exists(wisdom_path):
+                try:
+                    with open(wisdom_path, 'rb') as f:
+                        pyfftw.import_wisdom(pickle.load(f))
+                except Exception as e:
+                    print(f'Could not load FFTW wisdom from {wisdom_path} ({e})')
+    def rfft(self, x:np.ndarray, axis:int=-1)->np.ndarray:
+        if self.name == 'pyfftw':
+            return pyfftw.interfaces.numpy_fft.rfft(x, axis=axis, threads=self.workers)
+        elif self.name == 'scipy':
+            return scipy_fft.rfft(x, axis=axis, workers=self.workers)
+        return np.fft.rfft(x, axis=axis)
+    def save_wisdom(self):
+        '''Store what FFTW learned planning this session, so the next one starts with fast plans.'''
+        if self.name == 'pyfftw':
+            with open(self.wisdom_path, 'wb') as f:
+                pickle.dump(pyfftw.export_wisdom(), f)
+
+fft_backend = FFTBackend()
+
+def get_window(name:str, n:int)->np.ndarray:
+    '''Periodic (DFT-even) window of length n, which is what you want for spectral estimation.'''
+    windows = {'hann':np.hanning, 'hamming':np.hamming, 'blackman':np.blackman,
+               'bartlett':np.bartlett, 'boxcar':np.ones}
+    if name not in windows:
+        raise ValueError(f'Invalid window {name}. Should be one of {tuple(windows)}.')
+    if name == 'boxcar':
+        return np.ones(n)
+    return windows[name](n+1)[:-1]
+
+
+class WelchPSD:
+    '''Streaming Welch estimate of the one-sided PSD in V^2/Hz.
+       Samples are fed in as they arrive with update(), and only the new (overlapping) segments
+       are FFT'd, so the cost is proportional to new data rather than to the window length.
+       The segment PSDs are either averaged over everything fed since the last reset ('running')
+       or exponentially weighted with weight alpha for the newest segment ('exponential').
+       step (samples between segment starts) overrides overlap, and may be longer than nperseg to
+       skip samples between segments.'''
+    MAX_BATCH = 2**19 # float64 values per segments array (4 MB) that update works on at a time
+    def __init__(self, nperseg:int, dt:float, window:str='hann', overlap:float=0.5,
+                 averaging:str='exponential', alpha:float=0.1, scale:float=1., detrend:bool=True,
+                 fft:FFTBackend=None, step:int=None):
+        if averaging not in ('running', 'exponential'):
+            raise ValueError(f'Averaging must either be running or exponential, not {averaging}')
+        self.nperseg = nperseg
+        self.dt = dt
+        self.window_name = window
+        self.window = get_window(window, nperseg)
+        self.step = step or max(1, nperseg - int(nperseg*overlap))
+        self.averaging = averaging
+        self.alpha = alpha
+        self.scale = scale # multiplies the samples, e.g. volts per ADC count
+        self.detrend = detrend
+        self.fft = fft or fft_backend
+        self.freq = np.fft.rfftfreq(nperseg, dt)
+        # |X|^2 -> V^2/Hz, doubled for the negative frequencies except at DC and Nyquist
+        self.norm = np.full(self.freq.size, 2*dt/np.sum(self.window**2))
+        self.norm[0] /= 2
+        if nperseg % 2 == 0:
+            self.norm[-1] /= 2
+        # segment k is centered nperseg/2 samples after its start at k*step
+        self.bands = BandTracker(self.freq, t0=nperseg*dt/2, dt=self.step*dt)
+        self.reset()
+    def reset(self):
+        self.tail = np.zeros(0) # samples fed but not yet part of a complete segment
+        self.skip = 0 # samples still to drop before the next segment, when step > nperseg
+        self.psd = np.zeros(self.freq.size)
+        self.n_segments = 0
+        self.bands.clear()
+    def segment_psds(self, segments:np.ndarray)->np.ndarray:
+        '''PSD of every row of segments (n_segments x nperseg).'''
+        if self.detrend:
+            segments = segments - segments.mean(axis=1, keepdims=True)
+        return np.abs(self.fft.rfft(segments*self.window, axis=1))**2*self.norm
+    def update(self, x:np.ndarray)->int:
+        '''Feed new samples, returns how many new segments went into the estimate.
+           Long inputs go through in pieces of at most about MAX_BATCH values per segment array, 
+           so feeding a whole buffer at once doesn't need gigabytes of temporaries.'''
+        x = np.asarray(x)
+        piece = max(1, WelchPSD.MAX_BATCH//self.nperseg)*self.step
+        return sum(self._update(x[k:k+piece]) for k in range(0, x.size, piece))
+    def _update(self, x:np.ndarray)->int:
+        if self.skip:
+            drop = min(self.skip, x.size)
+            x, self.skip = x[drop:], self.skip-drop
+        buf = np.concatenate((self.tail, x.astype(np.float64)*self.scale))
+        if buf.size < self.nperseg:
+            self.tail = buf
+            return 0
+        segments = sliding_window_view(buf, self.nperseg)[::self.step]
+        consumed = segments.shape[0]*self.step
+        self.tail = buf[consumed:]
+        self.skip = max(0, consumed - buf.size)
+        psds = self.segment_psds(segments)
+        self.bands.add_segments(psds, self.n_segments)
+        self.add_psds(psds)
+        return segments.shape[0]
+    def add_psds(self, psds:np.ndarray):
+        '''Fold the PSDs of new segments (rows, oldest first) into the estimate.'''
+        n = psds.shape[0]
+        if self.averaging == 'running':
+            self.psd = (self.psd*self.n_segments + psds.sum(axis=0))/(self.n_segments + n)
+        else:
+            # the same as applying psd = (1-alpha)*psd + alpha*new for each segment in turn,
+            # except the first segment ever is taken as is
+            a = 1. if self.n_segments == 0 else self.alpha
+            weights = self.alpha*(1-self.alpha)**np.arange(n-1, -1, -1)
+            weights[0] = a*(1-self.alpha)**(n-1)
+            self.psd = (1-a)*(1-self.alpha)**(n-1)*self.psd + weights@psds
+        self.n_segments += n
+    def get_psd(self)->np.ndarray:
+        return self.psd
+
+
+class Spectrogram(WelchPSD):
+    '''Rolling spectrogram: the PSD of every segment (in dB re 1 V^2/Hz) goes into a row of a fixed
+       n_rows x len(freq) ring, so it costs the same no matter how long it runs. get_image()
+       quantizes it to uint8 for the browser's waterfall.'''
+    def __init__(self, nperseg:int, dt:float, n_rows:int=256, step:int=None, window:str='hann',
+                 scale:float=1., detrend:bool=True, fft:FFTBackend=None):
+        self.n_rows = n_rows
+        super().__init__(nperseg, dt, window=window, overlap=0., averaging='running', scale=scale,
+                         detrend=detrend, fft=fft, step=step)
+    def reset(self):
+        super().reset()
+        self.rows = np.full((self.n_rows, self.freq.size), np.nan, dtype=np.float32)
+        self.index = 0 # next row to write
+    def add_psds(self, psds:np.ndarray):
+        '''Write the new segment PSDs into the ring, like RingBuffer.extend but by rows.'''
+        db = 10*np.log10(psds[-self.n_rows:] + 1e-30)
+        n = db.shape[0]
+        end = self.index + n
+        if end <= self.n_rows:
+            self.rows[self.index:end] = db
+        else:
+            head = self.n_rows - self.index
+            self.rows[self.index:] = db[:head]
+            self.rows[:end-self.n_rows] = db[head:]
+        self.index = end % self.n_rows
+        self.n_segments += psds.shape[0]
+    def get_times(self)->np.ndarray:
+        '''Center time (s since the last reset) of every row of get_image, oldest first.'''
+        n = min(self.n_segments, self.n_rows)
+        return self.bands.t0 + self.step*self.dt*np.arange(self.n_segments-n, self.n_segments)
+    def get_image(self, db_min:float=None, db_max:float=None)->tuple[np.ndarray,float,float]:
+        '''Rows filled so far, oldest first, quantized to uint8 over (db_min, db_max), which default
+           to the range of the data. Returns the image and the dB range used.'''
+        n = min(self.n_segments, self.n_rows)
+        rows = np.roll(self.rows, -self.index, axis=0)[self.n_rows-n:]
+        if n and (db_min is None or db_max is None):
+            lo, hi = np.percentile(rows, (1, 99.9))
+            db_min = lo if db_min is None else db_min
+            db_max = hi if db_max is None else db_max
+        db_min = -200. if db_min is None else db_min
+        db_max = db_min+1 if db_max is None or db_max <= db_min else db_max
+        image = np.clip((rows - db_min)*(255/(db_max - db_min)), 0, 255).astype(np.uint8)
+        return image, float(db_min), float(db_max)
+
+class BandTracker:
+    '''Registry of named frequency bands whose integrated power (V^2) is tracked segment by segment.
+       Bands are stored as index ranges into freq, and the power of every band comes from one
+       cumulative sum over frequency per segment, so adding bands is close to free. Each band keeps
+       a time series of the last history segment powers (unaveraged) in a RingBuffer, the times being
+       the segment centers in seconds since the last reset.'''
+    def __init__(self, freq:np.ndarray, t0:float, dt:float, history:int=10000):
+        self.freq = freq
+        self.df = freq[1]-freq[0] if freq.size > 1 else 0.
+        self.t0 = t0
+        self.dt = dt
+        self.history = history
+        self.bands = {} # name -> [lo, hi, RingBuffer of powers]
+        self.time = RingBuffer(history)
+    def index_range(self, fLo:float, fHi:float)->tuple[int,int]:
+        '''Indices lo, hi such that freq[lo:hi] is every frequency strictly between fLo and fHi.'''
+        return np.searchsorted(self.freq, fLo, 'right'), np.searchsorted(self.freq, fHi, 'left')
+    def add(self, name:str, fLo:float, fHi:float):
+        if fHi <= fLo:
+            raise ValueError(f'Band {name} needs fLo < fHi, got ({fLo}, {fHi}).')
+        self.bands[name] = [*self.index_range(fLo, fHi), RingBuffer(self.history)]
+    def remove(self, name:str):
+        self.bands.pop(name, None)
+    def clear(self):
+        '''Forget the history of every band, but keep the bands.'''
+        self.time.reset()
+        for band in self.bands.values():
+            band[2].reset()
+    def integrate(self, psd:np.ndarray, fLo:float, fHi:float)->float:
+        '''Integral of a PSD (e.g. the averaged one) over (fLo, fHi), without registering a band.'''
+        lo, hi = self.index_range(fLo, fHi)
+        return float(np.sum(psd[lo:hi])*self.df)
+    def add_segments(self, psds:np.ndarray, first:int):
+        '''Append the band powers of new segment PSDs (rows, oldest first), first being the index
+           of psds[0] among all segments since the last reset.'''
+        n = psds.shape[0]
+        self.time.extend(self.t0 + self.dt*np.arange(first, first+n))
+        if not self.bands:
+            return
+        cumsum = np.zeros((n, psds.shape[1]+1))
+        np.cumsum(psds, axis=1, out=cumsum[:,1:])
+        for lo, hi, powers in self.bands.values():
+            powers.extend((cumsum[:,hi] - cumsum[:,lo])*self.df)
+    def get_powers(self, name:str)->tuple[np.ndarray,np.ndarray]:
+        '''(times, powers) of a band, oldest first. A band added later than the others has a
+           shorter history, so only the matching tail of the times is returned.'''
+        powers = self.bands[name][2].get_data()
+        times = self.time.get_data()
+        return times[len(times)-len(powers):], powers
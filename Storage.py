@@ -0,0 +1,386 @@
+import numpy as np
+import h5py
+import os, zlib, threading, queue, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK = 2**20 # samples per hdf5 chunk, 2 MB of int16
+
+def shuffle_bytes(chunk:np.ndarray)->bytes:
+    '''The hdf5 shuffle filter: all first bytes of the samples, then all second bytes, etc.'''
+    return chunk.view(np.uint8).reshape(-1, chunk.itemsize).T.tobytes()
+
+def deflate_chunk(chunk:np.ndarray, level:int)->bytes:
+    '''What hdf5's shuffle+gzip filters would store for chunk, done outside of hdf5 so the
+       chunks can be compressed on several threads (zlib releases the GIL).'''
+    return zlib.compress(shuffle_bytes(chunk), level)
+
+def ring_window(buff)->tuple:
+    '''What ring_chunks needs to know about the current contents of a BinnedRingBuffer. Take it
+       under the lock, for all the buffers that have to cover the same time at once.'''
+    return buff.data, buff.written, len(buff), buff.index if buff.full else 0
+
+def ring_chunks(buff, lock:threading.Lock, chunk:int=CHUNK, window:tuple=None):
+    '''Yield the contents of a BinnedRingBuffer oldest first, in copies of at most chunk samples,
+       each taken under lock so the acquisition thread can keep writing in between.
+       The window is the one given (see ring_window), or else the one at the first call; if the
+       acquisition laps the samples that are still to be saved (or the buffer is reset), this 
+       raises instead of mixing in new data.'''
+    if window is None:
+        with lock:
+            window = ring_window(buff)
+    data, written0, n, start = window
+    size = data.size
+    for k in range(0, n, chunk):
+        with lock:
+            if buff.data is not data:
+                raise RuntimeError('The buffer was reset while it was being saved.')
+            if buff.written - written0 > k + size - n:
+                raise RuntimeError('The acquisition overwrote the buffer before it was saved. '
+                                   'Stop streaming first or use a shorter window.')
+            m = min(chunk, n-k)
+            i = (start + k) % size
+            out = np.empty(m, dtype=data.dtype)
+            first = min(m, size-i)
+            out[:first] = data[i:i+first]
+            out[first:] = data[:m-first]
+        yield out
+
+
+class SaveJob:
+    '''Runs target(job, *args) on a background thread and keeps track of its progress, so the
+       caller (eel) can poll instead of blocking. target adds to job.done as it goes, out of job.total.'''
+    def __init__(self, target, *args, total:int=1):
+        self.total = max(total, 1)
+        self.done = 0
+        self.error = None
+        self.finished = False
+        self.thread = threading.Thread(target=self._run, args=(target, *args), daemon=True)
+    def _run(self, target, *args):
+        try:
+            target(self, *args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+    def start(self):
+        self.thread.start()
+        return self
+    def progress(self)->float:
+        return min(self.done/self.total, 1.)
+    def write_chunked(self, grp:h5py.Group, name:str, chunks, n:int, dtype=np.int16, compression:str='gzip',
+                      level:int=4, chunk:int=CHUNK, workers:int=None)->h5py.Dataset:
+        '''Write n samples coming from the iterable chunks (each chunk samples long except the last)
+           to a chunked dataset, compressed with shuffle+compression ('gzip', 'lzf' or None).
+           gzip chunks are compressed on a thread pool and written with write_direct_chunk,
+           the file itself is only ever touched from this thread.'''
+        if n == 0:
+            return grp.create_dataset(name, shape=(0,), dtype=dtype)
+        chunk = min(chunk, n)
+        dset = grp.create_dataset(name, shape=(n,), dtype=dtype, chunks=(chunk,),
+                                  compression=compression, compression_opts=level if compression == 'gzip' else None,
+                                  shuffle=compression is not None)
+        if compression != 'gzip':
+            offset = 0
+            for x in chunks:
+                dset[offset:offset+x.size] = x
+                offset += x.size
+                self.done += x.size
+            return dset
+
+        workers = workers or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = [] # (offset, size, future), in order, at most 2*workers chunks in memory
+            offset = 0
+            for x in chunks:
+                if x.size < chunk: # hdf5 always stores whole chunks, the edge one is padded
+                    x = np.concatenate((x, np.zeros(chunk-x.size, dtype=x.dtype)))
+                pending.append((offset, min(chunk, n-offset), pool.submit(deflate_chunk, x.astype(dtype, copy=False), level)))
+                offset += chunk
+                while len(pending) > 2*workers or (pending and pending[0][2].done()):
+                    self._write_direct(dset, *pending.pop(0))
+            for p in pending:
+                self._write_direct(dset, *p)
+        return dset
+    def _write_direct(self, dset:h5py.Dataset, offset:int, size:int, future):
+        dset.id.write_direct_chunk((offset,), future.result())
+        self.done += size
+
+
+class H5Recorder:
+    '''Continuous recording of a stream into hdf5 files, for as long as it runs.
+       write() is meant to be called from the acquisition thread: it only copies the chunks into a
+       queue, and a writer thread of its own appends them to resizable, chunked datasets
+       (<chan>_data), flushing every flush_interval seconds. Lost samples are annotated in the
+       'gaps' dataset as rows of (sample index, number of samples lost, -1 when unknown) and
+       overflows in 'overflows' as the sample index of the chunk they were reported with.
+       A new file (path_000.hdf5, path_001.hdf5, ...) is started once a file reaches max_bytes or
+       max_duration seconds of data, if given. Each file holds metadata (plus first_sample, the index
+       of its first sample in the whole recording) like py_save_buff does. If the writer falls more
+       than max_backlog samples behind, new chunks are dropped (and annotated as gaps) rather than
+       letting the queue eat all the memory.'''
+    def __init__(self, path:str, channels:list, dt:float, metadata:dict=None, compression:str='gzip',
+                 chunk:int=2**16, flush_interval:float=5., max_bytes:int=None, max_duration:float=None,
+                 max_backlog:int=2**27):
+        self.path = path
+        self.channels = list(channels)
+        self.dt = dt
+        self.metadata = metadata or {}
+        self.compression = compression
+        self.chunk = chunk
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_duration = max_duration
+        self.max_backlog = max_backlog
+        self.received = 0 # samples per channel handed to write(), including the dropped ones
+        self.queued = 0 # samples per channel queued, only ever touched by write()
+        self.written = 0 # samples per channel written over all files, only ever touched by the writer
+        self.paths = []
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='H5Recorder', daemon=True)
+        self.thread.start()
+    def write(self, chunks:dict, overflow:bool=False, lost:int=0):
+        '''Queue one chunk (array or tuple of views) per channel, all the same length. lost is
+           how many samples went missing right before this chunk, -1 if unknown.'''
+        if self.error is not None: # the writer is gone, don't pile up chunks for nobody
+            return
+        chunks = {chan:self._copy(chunks[chan]) for chan in self.channels}
+        n = len(chunks[self.channels[0]]) if self.channels else 0
+        if self.queued - self.written + n > self.max_backlog:
+            self.queue.put(('gap', -1 if lost < 0 else n+lost))
+        elif n or lost or overflow:
+            self.queued += n
+            self.queue.put(('data', chunks, overflow, lost))
+        self.received += n
+    @staticmethod
+    def _copy(x)->np.ndarray:
+        '''One contiguous copy of an array or of a tuple of views (e.g. RingBuffer.get_view()).'''
+        if isinstance(x, (tuple, list)):
+            return np.concatenate(x) if len(x) else np.zeros(0, dtype=np.int16)
+        return np.array(x)
+    def mark_gap(self, lost:int=-1):
+        '''Annotate a gap in the stream, e.g. when it is restarted. -1 if the length is unknown.'''
+        self.queue.put(('gap', lost))
+    def close(self):
+        '''Write everything still queued, close the file and stop the writer thread.'''
+        self.queue.put(('close',))
+        self.thread.join()
+    def _open(self):
+        path = f'{self.path}_{len(self.paths):03d}.hdf5'
+        f = h5py.File(path, 'w')
+        for chan in self.channels:
+            f.create_dataset(f'{chan}_data', shape=(0,), maxshape=(None,), dtype=np.int16, chunks=(self.chunk,),
+                             compression=self.compression, shuffle=self.compression is not None)
+        f.create_dataset('gaps', shape=(0,2), maxshape=(None,2), dtype=np.int64, chunks=(1024,2))
+        f.create_dataset('overflows', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(1024,))
+        for k,v in dict(self.metadata, t_per_pt_sec=self.dt, first_sample=self.written).items():
+            f.create_dataset(k, data=v)
+        self.paths.append(path)
+        return f
+    @staticmethod
+    def _append(dset:h5py.Dataset, x):
+        n = dset.shape[0]
+        dset.resize((n+len(x),) + dset.shape[1:])
+        dset[n:] = x
+    def _run(self):
+        f = None
+        in_file = 0 # samples per channel in the current file
+        last_flush = time.time()
+        try:
+            while True:
+                item = self.queue.get()
+                if item[0] == 'close':
+                    break
+                if f is None or (self.max_bytes and f.id.get_filesize() >= self.max_bytes) or \
+                   (self.max_duration and in_file*self.dt >= self.max_duration):
+                    if f is not None:
+                        f.close()
+                    f, in_file = self._open(), 0
+                if item[0] == 'gap':
+                    self._append(f['gaps'], [[in_file, item[1]]])
+                    continue
+                _, chunks, overflow, lost = item
+                if lost:
+                    self._append(f['gaps'], [[in_file, lost]])
+                if overflow:
+                    self._append(f['overflows'], [in_file])
+                for chan,x in chunks.items():
+                    self._append(f[f'{chan}_data'], x)
+                n = len(chunks[self.channels[0]])
+                in_file += n
+                self.written += n
+                if time.time() - last_flush > self.flush_interval:
+                    f.flush()
+                    last_flush = time.time()
+        except Exception as e:
+            print('ERROR in H5Recorder!', e)
+            self.error = e
+        finally:
+            if f is not None:
+                f.close()
+
+
+class H5Replay:
+    '''Lazy read access to a file written by py_save_buff (or one file of an H5Recorder), for replay.
+       Opening only reads the metadata. Samples are read a chunk at a time, and the decoded chunks
+       are kept in an LRU cache of up to cache_bytes, so panning around a window rereads nothing.
+       Overviews come from per-SUMMARY_BLOCK min/max/sum summaries, which a background thread builds
+       section by section (the ones the last view asked for first), so coarse views never wait for
+       the whole file to be decoded: their bins that aren't summarized yet are NaN until it gets there.'''
+    SUMMARY_BLOCK = 4096 # samples per summary entry
+    SUMMARY_SECTION = 256 # summary entries built at a time
+    def __init__(self, path:str, cache_bytes:int=2**28):
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        # py_save_buff puts everything in a group named after the acquisition time, H5Recorder doesn't
+        if any(k.endswith('_data') for k in self.file):
+            self.grp = self.file
+        else:
+            self.grp = self.file[next(iter(self.file))]
+        self.dsets = {chan:self.grp[f'{chan}_data'] for chan in ('A', 'B')
+                      if f'{chan}_data' in self.grp and self.grp[f'{chan}_data'].shape[0]}
+        if not self.dsets:
+            raise ValueError(f'No data in {path}.')
+        self.dt = float(self.grp['t_per_pt_sec'][()])
+        self.scale = {chan:float(self.grp[f'{chan}_volt_scale'][()]) if f'{chan}_volt_scale' in self.grp else 1.
+                      for chan in self.dsets}
+        self.n = min(d.shape[0] for d in self.dsets.values())
+        self.cache = OrderedDict() # (chan, chunk index) -> decoded chunk, least recently used first
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.lock = threading.Lock() # the summarizer thread reads through the same cache
+        n_blocks = self.n//self.SUMMARY_BLOCK
+        self.summaries = {chan:(np.zeros(n_blocks, d.dtype), np.zeros(n_blocks, d.dtype), np.zeros(n_blocks))
+                          for chan,d in self.dsets.items()}
+        self.summarized = {chan:np.zeros(-(-n_blocks//self.SUMMARY_SECTION), dtype=bool) for chan in self.dsets}
+        self.wanted = None # (chan, first section, last section + 1) the last coarse view needed
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._summarize_all, name='H5Replay', daemon=True)
+        self.thread.start()
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.cache.clear()
+        self.file.close()
+    def duration(self)->float:
+        return self.n*self.dt
+    def progress(self)->float:
+        '''Fraction of the summaries built so far.'''
+        done = sum(int(s.sum()) for s in self.summarized.values())
+        total = sum(s.size for s in self.summarized.values())
+        return done/total if total else 1.
+    def chunk_len(self, chan:str)->int:
+        dset = self.dsets[chan]
+        return dset.chunks[0] if dset.chunks else CHUNK
+    def _chunk(self, chan:str, i:int, cache:bool=True)->np.ndarray:
+        key = (chan, i)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            L = self.chunk_len(chan)
+            x = self.dsets[chan][i*L:(i+1)*L] # chunk aligned, so hdf5 decodes each chunk exactly once
+            if cache:
+                self.cache[key] = x
+                self.cached_bytes += x.nbytes
+                while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+                    self.cached_bytes -= self.cache.popitem(last=False)[1].nbytes
+            return x
+    def read(self, chan:str, start:int, stop:int, cache:bool=True)->np.ndarray:
+        '''Raw samples [start, stop) of a channel, in ADC counts. Pass cache=False for one-off
+           sequential passes, so they don't push the chunks being looked at out of the cache.'''
+        start, stop = max(start, 0), min(stop, self.n)
+        if stop <= start:
+            return np.zeros(0, dtype=self.dsets[chan].dtype)
+        L = self.chunk_len(chan)
+        pieces = [self._chunk(chan, i, cache)[max(start-i*L, 0):stop-i*L] for i in range(start//L, (stop-1)//L+1)]
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+    def decimation(self, n:int, max_samples:int)->int:
+        '''The factor to decimate n samples by to get at most max_samples. Factors of an eighth of a
+           SUMMARY_BLOCK or more are rounded up to whole blocks, so read_decimated takes them from the
+           summaries rather than decoding more than 512 samples per sample it returns.'''
+        factor = max(1, -(-n//max_samples))
+        B = self.SUMMARY_BLOCK
+        return factor if 8*factor < B else -(-factor//B)*B
+    def has_summaries(self, chan:str, start:int, stop:int)->bool:
+        '''Whether the summaries covering samples [start, stop) are all built.'''
+        S = self.SUMMARY_SECTION*self.SUMMARY_BLOCK
+        return bool(self.summarized[chan][start//S:-(-stop//S)].all())
+    def read_decimated(self, chan:str, start:int, stop:int, factor:int)->np.ndarray:
+        '''Means of every factor samples in [start, stop), a section at a time. Factors that are whole
+           SUMMARY_BLOCKs come from the summaries instead (start rounded down to a block), which
+           are built first if they aren't yet.'''
+        if factor == 1:
+            return self.read(chan, start, stop)
+        B = self.SUMMARY_BLOCK
+        if factor % B == 0 and self.summaries[chan][2].size:
+            g, b0 = factor//B, start//B
+            n_out = min((min(stop, self.n)-b0*B)//factor, (self.summaries[chan][2].size-b0)//g)
+            self._summarize(chan, b0, b0+n_out*g)
+            return self.summaries[chan][2][b0:b0+n_out*g].reshape(n_out, g).sum(axis=1)/factor
+        stop = start + (min(stop, self.n)-start)//factor*factor
+        section = factor*max(1, CHUNK//factor)
+        return np.concatenate([self.read(chan, k, min(k+section, stop), cache=False).reshape(-1, factor).mean(axis=1)
+                               for k in range(start, stop, section)] or [np.zeros(0)])
+    def _summarize_section(self, chan:str, s:int):
+        mins, maxs, sums = self.summaries[chan]
+        S, B = self.SUMMARY_SECTION, self.SUMMARY_BLOCK
+        e0, e1 = s*S, min((s+1)*S, mins.size)
+        x = self.read(chan, e0*B, e1*B, cache=False).reshape(-1, B)
+        mins[e0:e1], maxs[e0:e1], sums[e0:e1] = x.min(axis=1), x.max(axis=1), x.sum(axis=1, dtype=np.float64)
+        self.summarized[chan][s] = True
+    def _summarize(self, chan:str, b0:int, b1:int):
+        '''Make sure the summaries of blocks [b0, b1) are built.'''
+        S = self.SUMMARY_SECTION
+        for s in range(b0//S, -(-b1//S)):
+            if not self.summarized[chan][s]:
+                self._summarize_section(chan, s)
+    def _summarize_all(self):
+        '''Thread building every summary section, those in self.wanted first.'''
+        while not self.closed.is_set():
+            todo = None
+            if self.wanted is not None:
+                chan, s0, s1 = self.wanted
+                missing = np.flatnonzero(~self.summarized[chan][s0:s1])
+                if missing.size:
+                    todo = chan, s0 + int(missing[0])
+            for chan, done in self.summarized.items():
+                if todo is None and not done.all():
+                    todo = chan, int(np.argmin(done))
+            if todo is None:
+                return
+            self._summarize_section(*todo)
+    def get_envelope(self, chan:str, start:int, stop:int, n_bins:int)->tuple[np.ndarray,...]:
+        '''(time, min, max, mean) in seconds and volts of about n_bins bins over samples [start, stop),
+           and whether all of it is there. Bins of at least SUMMARY_BLOCK samples come from the
+           summaries (with start rounded down to a block), and are NaN where those aren't built yet. 
+           Finer ones come from the raw samples.'''
+        start, stop = max(start, 0), min(stop, self.n)
+        binsize = max(1, (stop-start)//max(n_bins, 1))
+        B, S = self.SUMMARY_BLOCK, self.SUMMARY_SECTION
+        complete = True
+        if binsize >= B and self.summaries[chan][0].size:
+            g = -(-binsize//B) # rounded up, so there are at most n_bins bins
+            b0 = start//B
+            n_bins = min((stop-b0*B)//(g*B), (self.summaries[chan][0].size-b0)//g)
+            b1 = b0 + n_bins*g
+            self.wanted = (chan, b0//S, -(-b1//S))
+            # a bin is only there once every section it overlaps is. Look before reading the
+            # summaries, the thread flags a section after writing it.
+            missing = np.concatenate(([0], np.cumsum(~self.summarized[chan])))
+            edges = b0 + g*np.arange(n_bins+1) # block edges of the bins
+            ready = missing[(edges[1:]-1)//S + 1] == missing[edges[:-1]//S]
+            mins, maxs, sums = (s[b0:b1].reshape(n_bins, g) for s in self.summaries[chan])
+            mn, mx, mean = mins.min(axis=1).astype(np.float64), maxs.max(axis=1).astype(np.float64), sums.sum(axis=1)/(g*B)
+            if not ready.all():
+                complete = False
+                mn[~ready] = mx[~ready] = mean[~ready] = np.nan
+            start, binsize = b0*B, g*B
+        else:
+            n_bins = (stop-start)//binsize
+            x = self.read(chan, start, start+n_bins*binsize).reshape(n_bins, binsize)
+            mn, mx, mean = x.min(axis=1), x.max(axis=1), x.mean(axis=1)
+        time = (start + binsize*np.arange(n_bins))*self.dt
+        s = self.scale[chan]
+        return time, mn*s, mx*s, mean*s, complete
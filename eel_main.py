@@ -1,7 +1,10 @@
 from picoscope4000 import picoscope4000
-from Buffer import BinnedRingBuffer
+from Buffer import BinnedRingBuffer, DiskBuffer
+from Spectrum import WelchPSD, Spectrogram, FFTBackend
+from Storage import SaveJob, H5Recorder, H5Replay, ring_chunks, ring_window
 
-import os, json, datetime
+import os, json, datetime, threading, base64
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import h5py
 import eel
@@ -32,6 +35,15 @@ eel.init('web') #name of the directory that has the html
 
 
 MAX_N_BINS = 100000
+POLL_INTERVAL = default.get('poll_interval', 0.01) # seconds between driver polls in the acquisition thread
+DRIVER_LATENCY = default.get('driver_latency', 2.) # seconds of data each driver buffer can hold, i.e. how long the acquisition thread may stall without an overflow
+PUSH_FPS = default.get('push_fps', 20) # target frames per second pushed to the browser in live mode
+SAVE_COMPRESSION = default.get('save_compression', 'gzip') # 'gzip', 'lzf' or None, always with shuffle
+RECORD_FLUSH_INTERVAL = default.get('record_flush_interval', 5) # seconds between flushes of the live recording
+RECORD_MAX_MB = default.get('record_max_mb') # start a new recording file past this size, None for never
+RECORD_MAX_MINUTES = default.get('record_max_minutes') # or past this much data
+REPLAY_MAX_SAMPLES = default.get('replay_max_samples', 2**22) # longer replay windows are decimated for the PSD
+PUSH_ACK_TIMEOUT = 2 # seconds to wait for the browser to ack a frame before sending another anyway
 pico = picoscope4000()
 try:
     pico.connect()
@@ -40,11 +52,135 @@ except Exception as e:
 buffA = BinnedRingBuffer(size=2, dtype=np.int16)
 buffB = BinnedRingBuffer(size=2, dtype=np.int16)
 stream_times = []
+buff_lock = threading.Lock() # the acquisition thread writes the buffers while eel reads them
+stream_status = {'overflow':False}
+disk_buffs = {} # channel -> DiskBuffer while streaming to disk
+push_state = {'running':False}
+save_state = {'job':None, 'path':None} # the background SaveJob of py_save_buff
+dir_index = {} # directory path -> (mtime, sorted subdirectory names), see list_subdirs
+dir_prefetch = {'running':False}
+replay_state = {'file':None, 'dt':None, 'loaded':None} # H5Replay opened by py_from_file, dt of what's in the buffers and the (start, stop, factor) it came from
+record_state = {'target':None, 'rec':None, 'dropped':0} # (dir, file_suffix) to record to and the H5Recorder
+axes_cache = {'key':None, 'version':0} # time/freq axes for the current (length, dt, binsize, PSD engines)
+psd_engines = {} # channel -> WelchPSD, rebuilt by py_pico_stream_setup and py_set_psd_options
+psd_synced = {} # channel -> buffer written count the engine has been fed up to
+psd_options = {'window':'hann', 'overlap':0.5, 'averaging':'exponential', 'nperseg':None, 'generation':0}
+psd_bands = {} # name -> (fLo, fHi), re-added to the engines whenever they are rebuilt
+MAX_NPERSEG = 2**16
+spec_engines = {} # channel -> Spectrogram, rebuilt along with psd_engines
+spec_synced = {}
+SPEC_ROWS = 256 # rows (time slices) of the waterfall, spread over the window
+SPEC_MAX_NPERSEG = 2048 # keeps the waterfall image small enough to send a few times a second
+# A and B are transformed in parallel, so each gets its share of the cores
+fft = FFTBackend(default.get('fft_backend'), default.get('fft_workers', max(1, (os.cpu_count() or 1)//2)))
+fft_pool = ThreadPoolExecutor(max_workers=2)
 
 def debug(*args):
     if False:
         print(*args)
 
+def get_dt()->float:
+    '''Time per sample in the buffers, the scope's or that of the file being replayed.'''
+    return replay_state['dt'] if replay_state['file'] is not None else pico.get_dt()
+
+def get_volt_scale(chan:str)->float:
+    if replay_state['file'] is not None:
+        return replay_state['file'].scale.get(chan, 1.)
+    ch = pico.channels[chan]
+    return ch.get_volt_scale() if ch.rng else 1.
+
+def close_replay():
+    if replay_state['file'] is not None:
+        replay_state['file'].close()
+        replay_state['file'] = None
+        replay_state['loaded'] = None
+
+def on_stream_data(res:dict):
+    '''Consumer for the picoscope acquisition thread, moves the latest views into the buffers.'''
+    with buff_lock:
+        for slc in res['A']:
+            if pico.channels['A'].enabled and len(slc):
+                buffA.extend(slc)
+        for slc in res['B']:
+            if pico.channels['B'].enabled and len(slc):
+                buffB.extend(slc)
+    stream_status['overflow'] |= pico.overflow
+pico.subscribe(on_stream_data)
+
+def on_disk_stream_data(res:dict):
+    '''Consumer writing the raw samples straight into the memmapped files of a disk stream.'''
+    for chan,buff in disk_buffs.items():
+        for slc in res[chan]:
+            buff.extend(slc)
+    if not pico.streaming:
+        finish_disk_stream()
+
+def finish_disk_stream():
+    pico.unsubscribe(on_disk_stream_data)
+    for chan,buff in disk_buffs.items():
+        print(f'Channel {chan} streamed to {buff.path} ({len(buff)} samples)')
+        buff.close()
+    disk_buffs.clear()
+
+def on_record_data(res:dict):
+    '''Consumer handing every chunk to the H5Recorder, along with the samples the driver dropped since.'''
+    rec = record_state['rec']
+    if rec is None: # finish_recording got there first
+        return
+    lost = pico.dropped_samples - record_state['dropped']
+    if lost < 0: # the stream was set up again, which resets the count
+        lost = pico.dropped_samples
+    record_state['dropped'] = pico.dropped_samples
+    rec.write(res, pico.overflow, lost)
+
+def start_recording():
+    '''Open the H5Recorder for the stream that was just set up. Has to happen before the acquisition
+    thread starts, so that the recording starts with the first sample.'''
+    dir, file_suffix = record_state['target']
+    chans = [chan for chan,ch in pico.channels.items() if ch.enabled]
+    metadata = {}
+    for chan in chans:
+        ch = pico.channels[chan]
+        metadata.update({f'{chan}_volt_scale':ch.get_volt_scale(), f'{chan}_volt_range':ch.get_volt_range(),
+                         f'{chan}_coupling':ch.coupling})
+    metadata.update(acquire_timestamp=stream_times[-1].timestamp(),
+                    acquire_datetime=stream_times[-1].strftime('%Y/%m/%d %H:%M:%S'))
+    record_state['rec'] = H5Recorder(os.path.splitext(make_save_path(dir, file_suffix, ''))[0], chans, 
+        pico.get_dt(), metadata=metadata, compression=SAVE_COMPRESSION, flush_interval=RECORD_FLUSH_INTERVAL,
+        max_bytes=RECORD_MAX_MB and RECORD_MAX_MB*2**20, max_duration=RECORD_MAX_MINUTES and RECORD_MAX_MINUTES*60)
+    record_state['dropped'] = pico.dropped_samples # only what's dropped from now on is a gap in this file
+    pico.subscribe(on_record_data)
+
+def finish_recording()->list[str]:
+    pico.unsubscribe(on_record_data)
+    rec = record_state['rec']
+    record_state['rec'] = None
+    if rec is None:
+        return []
+    rec.close()
+    print(f'Recorded {rec.written} samples per channel to {rec.paths}')
+    return rec.paths
+
+def encode_array(arr:np.ndarray, dtype=np.float32)->dict:
+    '''Pack an array as base64 of its raw little-endian bytes for sending to the browser, which is
+    far cheaper on both ends than .tolist() and JSON. main.js turns it back into a typed array with
+    decode_array.'''
+    arr = np.ascontiguousarray(arr, dtype=np.dtype(dtype).newbyteorder('<'))
+    return {'dtype':arr.dtype.name, 'b64':base64.b64encode(arr.data).decode('ascii')}
+
+def make_save_path(dir:str, file_suffix:str, ext:str)->str:
+    '''Build the output path from the directory picked in file_dialog (relative to the default 
+    starting dir) and the strftime-formatted file suffix.'''
+    path = ( default['directory'] + '\\' + dir + '\\' +
+             stream_times[-1].strftime(file_suffix) )
+    if not os.path.exists(os.path.dirname(path)):
+        path = ( default['directory'] + '\\'.join(dir.split('/')[1:]) + '\\' +
+                 stream_times[-1].strftime(file_suffix) )
+
+    if not path.endswith(ext):
+        path = path + ext
+    return path.replace('\\', '/').replace('//', '/').replace('//', '/').replace('//', '/')
+
 
 @eel.expose
 def py_pico_reconnect():
@@ -60,200 +196,609 @@ def py_pico_set_channel(chan:str, enable:bool, rng:float, coupling:str):
     pico.set_channel(chan=chan, enable=enable, rng=rng, coupling=coupling)
 
 @eel.expose
-def py_pico_stream_setup(stream_duration:float, buffer_duration:float, dt:float):
-    debug('in py_pico_stream_setup', stream_duration, buffer_duration, dt)
+def py_pico_stream_setup(stream_duration:float, buffer_duration:float, dt:float, downsample:int=1, ratio_mode:str='average'):
+    '''Start streaming into the buffers. With downsample > 1 the scope averages (or aggregates, keeping
+    the max, see picoscope4000.stream_setup) every downsample samples before they are sent over USB,
+    and the buffers, plots and PSDs all run at the downsampled rate. Returns the raw dt.'''
+    debug('in py_pico_stream_setup', stream_duration, buffer_duration, dt, downsample, ratio_mode)
 
-    buffsize = int(buffer_duration/dt)
+    downsample = max(1, int(downsample))
+    buffsize = int(buffer_duration/(dt*downsample))
+    close_replay()
 
-    buffA.reset(size=buffsize)
-    buffB.reset(size=buffsize)
+    with buff_lock:
+        buffA.reset(size=buffsize, dtype=np.int16) # replay may have left float data in them
+        buffB.reset(size=buffsize, dtype=np.int16)
+        axes_cache.update(key=None)
 
     stream_times.append(datetime.datetime.now())
-    pico.stream_setup( stream_duration, dt )
+    pico.stream_setup( stream_duration, dt, latency=DRIVER_LATENCY, downsample_ratio=downsample, ratio_mode=ratio_mode )
+    make_psd_engines()
+    if record_state['rec'] is not None: # live() restarting the stream, whatever happened in between is lost
+        record_state['rec'].mark_gap()
+        record_state['dropped'] = 0
+    elif record_state['target'] is not None:
+        start_recording()
+    pico.start_acquisition(POLL_INTERVAL)
 
-    return pico.get_dt() #pico will change dt
+    return pico.dt_nanos*1e-9 #pico will change dt
 
 @eel.expose
-def py_get_x_data(binsize:int):
-    debug('in py_get_x_data', binsize)
+def py_pico_stream_to_disk(dir:str, file_suffix:str, stream_duration:float, buffer_duration:float, dt:float):
+    '''Like py_pico_stream_setup, but every raw sample also goes into a preallocated memmapped file
+    per enabled channel, so the capture length is bounded by the disk instead of RAM. The in-memory
+    buffers only hold the last buffer_duration seconds for plotting.'''
+    debug('in py_pico_stream_to_disk', dir, file_suffix, stream_duration, buffer_duration, dt)
+
+    if disk_buffs:
+        finish_disk_stream()
 
-    if len(buffA):
-        time = np.linspace(0, pico.get_dt()*len(buffA),
-                           min(MAX_N_BINS, buffA.data.size//binsize)).tolist()
-        freq = np.fft.rfftfreq(len(time), time[1]-time[0]).tolist()
-    elif len(buffB):
-        time = np.linspace(0, pico.get_dt()*len(buffB),
-                           min(MAX_N_BINS, buffB.data.size//binsize)).tolist()
-        freq = np.fft.rfftfreq(len(time), time[1]-time[0]).tolist()
+    # the files have to be ready before the acquisition thread starts, or its first chunks are lost
+    stream_times.append(datetime.datetime.now())
+    base = os.path.splitext(make_save_path(dir, file_suffix, ''))[0]
+    for chan,ch in pico.channels.items():
+        if not ch.enabled:
+            continue
+        disk_buffs[chan] = DiskBuffer(size=int(np.round(stream_duration/dt)), dtype=np.int16,
+            path=f'{base}_{chan}.int16',
+            metadata=dict(channel=chan, volt_scale=ch.get_volt_scale(), volt_range=ch.get_volt_range(),
+                          coupling=ch.coupling, acquire_timestamp=stream_times[-1].timestamp(),
+                          acquire_datetime=stream_times[-1].strftime('%Y/%m/%d %H:%M:%S')))
+    pico.subscribe(on_disk_stream_data)
+
+    try:
+        dt = py_pico_stream_setup(stream_duration, buffer_duration, dt)
+    except Exception:
+        finish_disk_stream()
+        raise
+    for _,buff in disk_buffs.items():
+        buff.metadata['t_per_pt_sec'] = dt # pico will change dt
+
+    return dt, base
+
+def get_x_data(binsize:int)->tuple[np.ndarray,np.ndarray]:
+    '''Time and frequency axes for the binned buffers. Hold buff_lock for a consistent snapshot.
+    They are cached and only rebuilt (bumping axes_cache['version']) when the buffer length, dt or
+    binsize change, or after py_pico_stream_setup.'''
+    buff = buffA if len(buffA) else buffB
+    key = (len(buff), buff.data.size, get_dt(), binsize, psd_options['generation'])
+    if axes_cache['key'] == key:
+        return axes_cache['time'], axes_cache['freq']
+
+    if len(buff):
+        time = np.linspace(0, get_dt()*len(buff),
+                           min(MAX_N_BINS, buff.data.size//binsize))
     else:
-        time = []
-        freq = []
+        time = np.zeros(0)
+    # the PSDs come from the Welch engines, whose resolution doesn't depend on the binsize
+    freq = psd_engines['A'].freq if psd_engines else np.zeros(0)
+    axes_cache.update(key=key, time=time, freq=freq, version=axes_cache['version']+1)
+    return time, freq
+
+def make_psd_engines():
+    '''(Re)build the Welch PSD engines for the current buffers, dt, channel ranges and psd_options.
+    Unless set, the segment length is the largest power of two that fits 8 times in the window,
+    and the exponential averaging forgets on about the time scale of the window. The spectrograms
+    take SPEC_ROWS segments spread evenly over the window.'''
+    buffsize = max(buffA.data.size, buffB.data.size) # a replayed file may only have one channel
+    nperseg = psd_options['nperseg'] or 2**int(np.log2(max(buffsize//8, 16)))
+    nperseg = min(nperseg, MAX_NPERSEG, buffsize)
+    step = max(1, nperseg - int(nperseg*psd_options['overlap']))
+    for chan in pico.channels:
+        psd_engines[chan] = WelchPSD(nperseg, get_dt(), window=psd_options['window'],
+            overlap=psd_options['overlap'], averaging=psd_options['averaging'],
+            alpha=min(1., step/buffsize), scale=get_volt_scale(chan), fft=fft)
+        for name,(fLo,fHi) in psd_bands.items():
+            psd_engines[chan].bands.add(name, fLo, fHi)
+        psd_synced[chan] = 0
+
+        spec_nperseg = min(nperseg, SPEC_MAX_NPERSEG)
+        spec_engines[chan] = Spectrogram(spec_nperseg, get_dt(), n_rows=SPEC_ROWS,
+            step=max(spec_nperseg//2, buffsize//SPEC_ROWS), window=psd_options['window'],
+            scale=get_volt_scale(chan), fft=fft)
+        spec_synced[chan] = 0
+    psd_options['generation'] += 1
+
+def take_new(engines:dict, synced:dict)->dict[str,np.ndarray]:
+    '''Copies of the samples the engines (WelchPSD or Spectrogram per channel) haven't seen yet, 
+    marking them as seen. Hold buff_lock.'''
+    new = {}
+    for chan,buff in (('A', buffA), ('B', buffB)):
+        if chan in engines and buff.written > synced[chan]:
+            new[chan] = np.concatenate(buff.get_new(synced[chan]))
+            synced[chan] = buff.written
+    return new
+
+def feed_engines(engines:dict, synced:dict, new:dict=None):
+    '''Feed whatever arrived since the last call to the engines, or new if it was already taken with
+    take_new. Only the copy of the new samples happens under buff_lock, the FFTs don't need it and the 
+    channels are done in parallel (the FFT libraries release the GIL).'''
+    if new is None:
+        with buff_lock:
+            new = take_new(engines, synced)
+    list(fft_pool.map(lambda item: engines[item[0]].update(item[1]), new.items()))
+
+def update_psd(new:dict=None)->dict[str,np.ndarray]:
+    '''Bring the PSD engines up to date (with new if given, see take_new) and return their estimates.'''
+    feed_engines(psd_engines, psd_synced, new)
+    return {chan:engine.get_psd() for chan,engine in psd_engines.items()}
+
+def plot_binsize(binsize:int)->int:
+    '''The binsize to plot with: at least binsize, at most MAX_N_BINS bins, and rounded so the 
+    envelopes come straight from the min/max pyramid instead of a pass over the whole buffer.
+    Never longer than the buffer, so there's always a bin.'''
+    binsize = max(binsize, buffA.data.size//MAX_N_BINS, 1)
+    return min(buffA.envelope_binsize(binsize), max(buffA.data.size, 1))
+
+def get_traces(binsize:int)->dict[str,np.ndarray]:
+    '''Binned means and min/max envelopes in volts. Hold buff_lock for a consistent snapshot.'''
+    res = {}
+    for chan,buff in (('A', buffA), ('B', buffB)):
+        # min/max envelopes so spikes narrower than a bin still show up in the plot
+        # the buffers hold ADC counts, they're only converted to volts after binning
+        res[chan+'_min'], res[chan+'_max'], res[chan] = buff.get_envelope(binsize, get_volt_scale(chan))
+    return res
 
-    return { 'time':time, 'freq':freq }
+def pop_stream_status()->dict:
+    '''Whether anything overflowed since the last call, and whether we're still streaming.'''
+    # The acquisition thread does the polling. Poll here directly in case the thread isn't running.
+    if pico.streaming and not pico.is_acquiring():
+        pico.publish_latest()
+
+    overflow = stream_status['overflow']
+    stream_status['overflow'] = False
+    # still "streaming" until the acquisition thread has published the last chunk
+    return { 'overflow':overflow, 'streaming':pico.streaming or pico.is_acquiring(),
+             'dropped_samples':pico.dropped_samples }
 
 @eel.expose
-def py_pico_stream_to_buff():
-    debug('in py_pico_stream_to_buff')
+def py_get_x_data(binsize:int):
+    debug('in py_get_x_data', binsize)
 
-    pico.stream_latest()
-    res = pico.get_latest_streamed_data()
+    with buff_lock:
+        time, freq = get_x_data(binsize)
+    return { 'time':encode_array(time, np.float64), 'freq':encode_array(freq, np.float64) }
 
-    if pico.channels['A'].enabled and len(res['A']):
-        buffA.extend(res['A'])
-    if pico.channels['B'].enabled and len(res['B']):
-        buffB.extend(res['B'])
+@eel.expose
+def py_pico_stream_to_buff():
+    debug('in py_pico_stream_to_buff')
 
-    return pico.overflow
+    return pop_stream_status()['overflow']
 
 @eel.expose
 def py_get_buff_data(binsize:int):
     debug('in py_get_buff_data', binsize)
 
-    binsize = max(binsize, buffA.data.size//MAX_N_BINS)
+    binsize = plot_binsize(binsize)
 
-    return { 'A': (buffA.get_data(binsize)*pico.channels['A'].get_volt_scale()).tolist() ,
-             'B': (buffB.get_data(binsize)*pico.channels['B'].get_volt_scale()).tolist() }
+    with buff_lock:
+        res = get_traces(binsize)
+    return {k:encode_array(v) for k,v in res.items()}
 
 @eel.expose
 def py_pico_is_streaming():
     debug('in py_pico_is_streaming')
 
-    return pico.streaming
+    # still "streaming" until the acquisition thread has published the last chunk
+    return pico.streaming or pico.is_acquiring()
 
 @eel.expose
 def py_get_psd(binsize:int):
-    '''Get PSD data in V^2/Hz.'''
+    '''Get PSD data in V^2/Hz. The Welch estimate is made from the unbinned data, so binsize 
+    doesn't matter anymore; it's kept so the signature matches the other plot endpoints.'''
     debug('in py_get_fft', binsize)
 
-    binsize = max(binsize, buffA.data.size//MAX_N_BINS)
+    psd = update_psd()
+    return { chan:encode_array(psd.get(chan, np.zeros(0))) for chan in ('A', 'B') }
+
+@eel.expose
+def py_get_spectrogram(db_min:float=None, db_max:float=None):
+    '''Waterfall images per channel, rows oldest first and one column per frequency, quantized to 
+    uint8 over (db_min, db_max) in dB re 1 V^2/Hz (by default the range of the data, which is sent 
+    back so the browser can label the colorbar).'''
+    debug('in py_get_spectrogram', db_min, db_max)
+
+    feed_engines(spec_engines, spec_synced)
     res = {}
-    # Computing the PSD:
-    #  numpy does not normalize the FFT by default. 
-    try:
-        scale = pico.channels['A'].get_volt_scale()*pico.get_dt()*binsize/(len(buffA)//binsize)
-        res['A'] = (np.abs(np.fft.rfft(buffA.get_data(binsize))**2)*scale).tolist()
-    except Exception as e:
-        res['A'] = []
-    
+    for chan,engine in spec_engines.items():
+        image, lo, hi = engine.get_image(db_min, db_max)
+        res[chan] = {'image':encode_array(image, np.uint8), 'rows':image.shape[0], 'cols':image.shape[1],
+                     'db_min':lo, 'db_max':hi, 'time':encode_array(engine.get_times(), np.float64),
+                     'freq':encode_array(engine.freq, np.float64)}
+    return res
+
+@eel.expose
+def py_set_psd_options(options:dict):
+    '''Change the PSD window, overlap, averaging ('running' or 'exponential') or nperseg (None
+    picks one from the window length). This restarts the averaging.'''
+    debug('in py_set_psd_options', options)
+
+    psd_options.update({k:v for k,v in options.items() if k in ('window', 'overlap', 'averaging', 'nperseg')})
+    if psd_engines:
+        make_psd_engines()
+
+@eel.expose
+def py_get_frame(binsize:int, options:dict=None):
+    '''Everything plot() needs in one round trip, all from the same snapshot of the buffers: 
+    the stream status, time/freq axes, traces (binned means and envelopes, in volts) and PSDs.
+    options can turn parts off, e.g. {'psd':False}. The axes are only included when their version
+    differs from options['axes_version'], the one the browser already has.'''
+    debug('in py_get_frame', binsize, options)
+
+    options = dict({'axes':True, 'traces':True, 'psd':True, 'axes_version':None}, **(options or {}))
+    binsize = plot_binsize(binsize)
+    frame = pop_stream_status()
+
+    with buff_lock:
+        time, freq = get_x_data(binsize)
+        frame['axes_version'] = axes_cache['version']
+        if options['traces']:
+            traces = get_traces(binsize)
+        if options['psd']:
+            new = take_new(psd_engines, psd_synced)
+    # the FFTs don't need the lock
+    if options['axes'] and options['axes_version'] != frame['axes_version']:
+        frame['time'], frame['freq'] = encode_array(time, np.float64), encode_array(freq, np.float64)
+    if options['traces']:
+        frame.update({k:encode_array(v) for k,v in traces.items()})
+    if options['psd']:
+        psd = update_psd(new)
+        frame['psd_A'] = encode_array(psd.get('A', np.zeros(0)))
+        frame['psd_B'] = encode_array(psd.get('B', np.zeros(0)))
+    return frame
+
+def push_frames():
+    '''Producer for py_start_push. Runs as an eel greenlet, since eel.js_* calls have to come from
+    eel's own event loop rather than an OS thread. A new frame is only sent once the browser has acked
+    the previous one, otherwise the tick is dropped, so the browser always draws the newest snapshot
+    and never has a backlog to work through. If making a frame fails, the browser gets {'error':...}
+    instead and the producer stops, so the next py_start_push starts a new one.'''
     try:
-        scale = pico.channels['B'].get_volt_scale()*pico.get_dt()*binsize/(len(buffB)//binsize)
-        res['B'] = np.abs(np.fft.rfft(buffB.get_data(binsize)*scale)).tolist()
+        while push_state['running']:
+            t0 = datetime.datetime.now().timestamp()
+            if push_state['acked'] == push_state['sent'] or t0 - push_state['sent_at'] > PUSH_ACK_TIMEOUT:
+                frame = py_get_frame(push_state['binsize'], {'axes_version':push_state['axes_version']})
+                frame['id'] = push_state['sent'] + 1
+                frame['dropped_frames'] = push_state['dropped']
+                eel.js_on_frame(frame)
+                push_state['sent'], push_state['sent_at'] = frame['id'], t0
+            else:
+                push_state['dropped'] += 1
+            eel.sleep(max(0, 1/push_state['fps'] - (datetime.datetime.now().timestamp() - t0)))
     except Exception as e:
-        res['B'] = []
+        print('ERROR pushing frames!', repr(e))
+        eel.js_on_frame({'error':repr(e)})
+    finally:
+        push_state['running'] = False
 
-    return res
+@eel.expose
+def py_start_push(binsize:int, fps:float=None):
+    '''Start pushing frames (see py_get_frame) to js_on_frame at fps frames per second, by default PUSH_FPS.'''
+    debug('in py_start_push', binsize, fps)
+
+    push_state.update(binsize=binsize, fps=fps or PUSH_FPS, acked=0, sent=0, sent_at=0, dropped=0,
+                      axes_version=None)
+    if not push_state['running']:
+        push_state['running'] = True
+        eel.spawn(push_frames)
+
+@eel.expose
+def py_set_push_binsize(binsize:int):
+    push_state['binsize'] = binsize
+
+@eel.expose
+def py_frame_ack(frame_id:int, axes_version:int=None):
+    '''The browser is done with frame_id and holds the axes of axes_version.'''
+    push_state['acked'] = frame_id
+    push_state['axes_version'] = axes_version
+
+@eel.expose
+def py_stop_push():
+    debug('in py_stop_push')
+
+    push_state['running'] = False
 
 @eel.expose
 def py_get_psd_integral(fLo:float, fHi:float):
-    '''Get integral of PSD over bandwidth defined by (fLo, fHi)
+    '''Get integral of PSD over bandwidth defined by (fLo, fHi), in V^2. Uses the averaged PSD 
+    of the streaming engines rather than an FFT of the whole buffer.
     '''
+    debug('in py_get_psd_integral', fLo, fHi)
 
-    if len(buffA):
-        freq = np.fft.rfftfreq(len(buffA), pico.get_dt())
-        scale = pico.channels['A'].get_volt_scale()*pico.get_dt()/(len(buffA))
-        psd = (np.abs(np.fft.rfft(buffA.get_data(1))**2)*scale)
-        resA = np.sum( psd[(fLo<freq)*(freq<fHi)] )*(freq[1]-freq[0])
-    else:
-        resA = None
-    if len(buffB):
-        freq = np.fft.rfftfreq(len(buffB), pico.get_dt())
-        scale = pico.channels['B'].get_volt_scale()*pico.get_dt()/(len(buffB))
-        psd = (np.abs(np.fft.rfft(buffB.get_data(1))**2)*scale)
-        resB = np.sum( psd[(fLo<freq)*(freq<fHi)] )*(freq[1]-freq[0])
-    else:
-        resB = None
+    update_psd()
+    return { chan:(psd_engines[chan].bands.integrate(psd_engines[chan].psd, fLo, fHi)
+                   if chan in psd_engines and psd_engines[chan].n_segments else None)
+             for chan in ('A', 'B') }
+
+@eel.expose
+def py_add_band(name:str, fLo:float, fHi:float):
+    '''Track the power in (fLo, fHi) of every new PSD segment under name, replacing any band 
+    with the same name.'''
+    debug('in py_add_band', name, fLo, fHi)
+
+    for engine in psd_engines.values():
+        engine.bands.add(name, fLo, fHi) # raises before psd_bands is touched if the band is invalid
+    psd_bands[name] = (fLo, fHi)
+
+@eel.expose
+def py_remove_band(name:str):
+    debug('in py_remove_band', name)
 
-    return {'A':resA, 'B':resB}
+    psd_bands.pop(name, None)
+    for engine in psd_engines.values():
+        engine.bands.remove(name)
+
+@eel.expose
+def py_get_band_powers(names:list=None):
+    '''Time series of the band powers (V^2) per channel, {chan:{name:{'time', 'power'}}}, with
+    time in seconds since the stream (or the PSD averaging) started. names defaults to every band.'''
+    debug('in py_get_band_powers', names)
+
+    update_psd()
+    names = list(psd_bands) if names is None else names
+    res = {}
+    for chan,engine in psd_engines.items():
+        res[chan] = {}
+        for name in names:
+            time, power = engine.bands.get_powers(name)
+            res[chan][name] = {'time':encode_array(time, np.float64), 'power':encode_array(power)}
+    return res
 
 @eel.expose
 def py_pico_stop():
     debug('in py_pico_stop')
 
     pico.stop()
+    if disk_buffs:
+        finish_disk_stream()
+    fft.save_wisdom()
+    py_stop_recording()
 
 @eel.expose
-def py_get_dir_structure():
-    debug('in py_get_dir_structure')
+def py_start_recording(dir:str, file_suffix:str):
+    '''Record everything streamed from the next py_pico_stream_setup on (or from now, when already 
+    streaming) to hdf5 files, until py_stop_recording or py_pico_stop.'''
+    debug('in py_start_recording', dir, file_suffix)
+
+    record_state['target'] = (dir, file_suffix)
+    if pico.streaming and record_state['rec'] is None:
+        start_recording()
 
+@eel.expose
+def py_stop_recording():
+    '''Stop recording, returns the paths of the files written.'''
+    debug('in py_stop_recording')
+
+    record_state['target'] = None
+    return finish_recording()
+
+def exclude_dir(dir:str)->bool:
+    #skip dirs like .git
+    if dir.startswith('.'):
+        return True
+    elif dir == '__pycache__':
+        return True
+    return False
+
+def get_root_dir()->str:
     root_dir = default['directory']
     if not root_dir.endswith('\\'):
         root_dir = root_dir+'\\'
-    dir_structure = []
+    return root_dir
 
-    def exclude(dir:str)->bool:
-        if dir.startswith('.'):
-            return True
-        elif dir == '__pycache__':
-            return True
-        return False
+def list_subdirs(path:str)->list[str]:
+    '''Sorted names of the subdirectories of path, from dir_index unless the directory's mtime says
+    entries were added, removed or renamed since it was listed. Unreadable directories have none.'''
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        dir_index.pop(path, None)
+        return []
+    cached = dir_index.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        with os.scandir(path) as it:
+            names = sorted(e.name for e in it if not exclude_dir(e.name) and e.is_dir())
+    except OSError:
+        names = []
+    dir_index[path] = (mtime, names)
+    return names
+
+def prefetch_subdirs(paths:list[str]):
+    '''Index the next level in the background (an eel greenlet), so expanding it in file_dialog is
+    instant and we know which directories have children at all.'''
+    for path in paths:
+        list_subdirs(path)
+        eel.sleep(0) # let eel serve requests in between
+    dir_prefetch['running'] = False
+
+def dir_from_tree_path(tree_path:str)->str:
+    '''file_dialog paths are like root_name/sub/subsub, root_name being the last part of the default dir.'''
+    return get_root_dir() + '\\'.join(tree_path.replace('\\', '/').split('/')[1:])
 
-    for root, dirs, _ in os.walk(root_dir, topdown=True):
-        #skip dirs like .git
-        dirs[:] = [d for d in dirs if not exclude(d)]
+@eel.expose
+def py_get_dir_children(tree_path:str=''):
+    '''One level of the directory tree under the default dir, for file_dialog to expand on demand.
+    tree_path '' is the level holding just the default dir itself. has_children is None when the
+    child hasn't been listed yet (it will be shortly, in the background).'''
+    debug('in py_get_dir_children', tree_path)
+
+    if not tree_path:
+        return [{'name':get_root_dir().split('\\')[-2], 'has_children':True}]
+    path = dir_from_tree_path(tree_path)
+    children = []
+    todo = []
+    for name in list_subdirs(path):
+        child = os.path.join(path, name)
+        cached = dir_index.get(child)
+        children.append({'name':name, 'has_children':None if cached is None else bool(cached[1])})
+        if cached is None:
+            todo.append(child)
+    if todo and not dir_prefetch['running']:
+        dir_prefetch['running'] = True
+        eel.spawn(prefetch_subdirs, todo)
+    return children
 
-        root = root_dir.split('\\')[-2] + '\\' + root.replace(root_dir, '')
-        for dir in dirs:
-            path = os.path.join(root, dir).replace('/', '\\') #just to make sure we're using \ not /
-            dir_structure.append(path)
+@eel.expose
+def py_get_dir_structure():
+    '''Every directory under the default dir, as root_name\\sub\\subsub paths. Goes through 
+    dir_index, so only directories that changed are listed again. file_dialog uses the lazy
+    py_get_dir_children instead.'''
+    debug('in py_get_dir_structure')
+
+    root_dir = get_root_dir()
+    root_name = root_dir.split('\\')[-2]
+    dir_structure = []
+    todo = [(root_dir, root_name)]
+    while todo:
+        path, root = todo.pop()
+        for dir in list_subdirs(path):
+            dir_structure.append(root + '\\' + dir)
+            todo.append((os.path.join(path, dir), root + '\\' + dir))
 
     return sorted( dir_structure )
 
+def write_buff(job:SaveJob, path:str, binsize:int):
+    '''Save job target for py_save_buff. Raw data (binsize 1) is streamed out of the ring buffers 
+    as chunked, compressed int16, binned data is small enough to take in one go.'''
+    with h5py.File(path, "w") as f:
+        root = stream_times[-1].strftime('%Y%m%d_%H%M%S')
+        grp = f.create_group(root)
+
+        # both channels as of the same moment, the acquisition may keep writing while they're saved
+        buffs = {'A':buffA, 'B':buffB}
+        with buff_lock:
+            if binsize == 1:
+                windows = {chan:ring_window(buff) for chan,buff in buffs.items()}
+            else:
+                binned = {chan:buff.get_data(binsize) for chan,buff in buffs.items()}
+        for chan,buff in buffs.items():
+            if binsize == 1:
+                job.write_chunked(grp, f'{chan}_data', ring_chunks(buff, buff_lock, window=windows[chan]), 
+                                  windows[chan][2], compression=SAVE_COMPRESSION)
+            else:
+                data = binned[chan]
+                grp.create_dataset(f'{chan}_data', data = data, chunks=True if data.size else None, 
+                                   compression=SAVE_COMPRESSION if data.size else None)
+                job.done += len(data)*binsize
+
+        grp.create_dataset('A_volt_scale', data = pico.channels['A'].get_volt_scale())
+        grp.create_dataset('B_volt_scale', data = pico.channels['B'].get_volt_scale())
+
+        grp.create_dataset('A_volt_offset', data = 0)
+        grp.create_dataset('B_volt_offset', data = 0)
+
+        grp.create_dataset('t_per_pt_sec_before_bin', data = pico.get_dt()) # done this way because the picoscope does int casting
+        grp.create_dataset('binsize', data = binsize)
+        grp.create_dataset('t_per_pt_sec', data = pico.get_dt()*binsize) # done this way because the picoscope does int casting
+
+        grp.create_dataset('acquire_timestamp', data = stream_times[-1].timestamp())
+        grp.create_dataset('acquire_datetime',  data = stream_times[-1].strftime('%Y/%m/%d %H:%M:%S'))
+
+        grp.create_dataset('data_notes', data='To scale data from ADCs to volts, multiply by volt_scale, NOT volt_range. If the data is binned, the binsize indicates how large the bins were. t_per_pt_sec is always the effective sampling rate after binning, in seconds. Timestamp is the time that the acquisition began. The picoscope does not seem reliable at the max sampling rate of 10 MHz when acquiring two channels - the sampling rate seems to fall to 5 MHz after about a second, but the picoscope will not tell you this has happened. The picoscope does not allow arbitrary sampling rates; it will always truncate the time between points to the nearest multiple of 100 ns. This means that you cannot set it to 6.7 MHz (max two-channel acquisition speed from the datasheet) which is ~150 ns per point.')
+        
+        grp.create_dataset('A_volt_range', data = pico.channels['A'].get_volt_range())
+        grp.create_dataset('B_volt_range', data = pico.channels['B'].get_volt_range())
+        grp.create_dataset('A_enabled', data = pico.channels['A'].enabled)
+        grp.create_dataset('B_enabled', data = pico.channels['B'].enabled)
+        grp.create_dataset('A_coupling', data = pico.channels['A'].coupling)
+        grp.create_dataset('B_coupling', data = pico.channels['B'].coupling)
+
 @eel.expose
 def py_save_buff(dir:str, file_suffix:str, binsize:int):
+    '''Start saving the buffers in the background. Poll py_get_save_progress for when it's done.'''
     debug('in py_save_buff', dir, file_suffix, binsize)
 
     #dir here is from the default starting dir
     try:
-        path = ( default['directory'] + '\\' + dir + '\\' +
-                 stream_times[-1].strftime(file_suffix) )
-        if not os.path.exists(os.path.dirname(path)):
-            path = ( default['directory'] + '\\'.join(dir.split('/')[1:]) + '\\' +
-                     stream_times[-1].strftime(file_suffix) )
-
-        if not path.endswith('.hdf5'):
-            path = path + '.hdf5'
-        path = path.replace('\\', '/').replace('//', '/').replace('//', '/').replace('//', '/')
-
-        with h5py.File(path, "w") as f:
-            root = stream_times[-1].strftime('%Y%m%d_%H%M%S')
-            grp = f.create_group(root)
-
-            grp.create_dataset('A_data', data = buffA.get_data(binsize) )
-            grp.create_dataset('B_data', data = buffB.get_data(binsize) )
-
-            grp.create_dataset('A_volt_scale', data = pico.channels['A'].get_volt_scale())
-            grp.create_dataset('B_volt_scale', data = pico.channels['B'].get_volt_scale())
-
-            grp.create_dataset('A_volt_offset', data = 0)
-            grp.create_dataset('B_volt_offset', data = 0)
-
-            grp.create_dataset('t_per_pt_sec_before_bin', data = pico.get_dt()) # done this way because the picoscope does int casting
-            grp.create_dataset('binsize', data = binsize)
-            grp.create_dataset('t_per_pt_sec', data = pico.get_dt()*binsize) # done this way because the picoscope does int casting
-
-            grp.create_dataset('acquire_timestamp', data = stream_times[-1].timestamp())
-            grp.create_dataset('acquire_datetime',  data = stream_times[-1].strftime('%Y/%m/%d %H:%M:%S'))
-
-            grp.create_dataset('data_notes', data='To scale data from ADCs to volts, multiply by volt_scale, NOT volt_range. If the data is binned, the binsize indicates how large the bins were. t_per_pt_sec is always the effective sampling rate after binning, in seconds. Timestamp is the time that the acquisition began. The picoscope does not seem reliable at the max sampling rate of 10 MHz when acquiring two channels - the sampling rate seems to fall to 5 MHz after about a second, but the picoscope will not tell you this has happened. The picoscope does not allow arbitrary sampling rates; it will always truncate the time between points to the nearest multiple of 100 ns. This means that you cannot set it to 6.7 MHz (max two-channel acquisition speed from the datasheet) which is ~150 ns per point.')
-            
-            grp.create_dataset('A_volt_range', data = pico.channels['A'].get_volt_range())
-            grp.create_dataset('B_volt_range', data = pico.channels['B'].get_volt_range())
-            grp.create_dataset('A_enabled', data = pico.channels['A'].enabled)
-            grp.create_dataset('B_enabled', data = pico.channels['B'].enabled)
-            grp.create_dataset('A_coupling', data = pico.channels['A'].coupling)
-            grp.create_dataset('B_coupling', data = pico.channels['B'].coupling)
-
-        print(f'File saved to {path}')
-        return True, f'File saved!', path
+        if save_state['job'] is not None and not save_state['job'].finished:
+            raise RuntimeError('Still saving the previous file.')
+        path = make_save_path(dir, file_suffix, '.hdf5')
+        save_state['path'] = path
+        save_state['job'] = SaveJob(write_buff, path, binsize, total=len(buffA)+len(buffB)).start()
+        return True, f'Saving...', path
     except Exception as e:
         print('FILE NOT SAVED! ERROR: ', e)
         return False, f'ERROR: File NOT saved!', str(e)
 
+@eel.expose
+def py_get_save_progress():
+    '''Progress (0 to 1) of the save started by py_save_buff, and once finished the same 
+    (ok, title, message) that py_save_buff used to return.'''
+    job, path = save_state['job'], save_state['path']
+    if job is None:
+        return {'progress':1., 'finished':True, 'msg':[False, 'ERROR: Nothing is being saved!', '']}
+    res = {'progress':job.progress(), 'finished':job.finished}
+    if job.finished:
+        if job.error is None:
+            print(f'File saved to {path}')
+            res['msg'] = [True, f'File saved!', path]
+        else:
+            print('FILE NOT SAVED! ERROR: ', job.error)
+            res['msg'] = [False, f'ERROR: File NOT saved!', str(job.error)]
+    return res
+
 @eel.expose
 def py_from_file(path:str):
-    raise NotImplementedError
-    with h5py.File(path, 'r') as f:
-        pass
+    '''Open a file written by py_save_buff (or the recorder) for replay. Nothing but the metadata is
+    read until py_replay_window asks for a window. path may be relative to the default directory.'''
+    debug('in py_from_file', path)
+
+    if pico.streaming:
+        raise ValueError('Stop streaming before opening a file.')
+    if not os.path.isabs(path):
+        path = os.path.join(default['directory'], path)
+    close_replay()
+    replay_state['file'] = f = H5Replay(path)
+    replay_state['dt'] = f.dt
+    return {'path':path, 'dt':f.dt, 'n':f.n, 'duration':f.duration(), 'channels':list(f.dsets)}
+
+@eel.expose
+def py_replay_window(t0:float=0., t1:float=None, n_bins:int=2000):
+    '''A frame (like py_get_frame's, always with the axes) of the window (t0, t1) in seconds of the
+    file opened with py_from_file. The traces come from the file's chunk cache and summaries. The 
+    window is also loaded into the buffers, decimated by block means if it is longer than 
+    REPLAY_MAX_SAMPLES, and the PSDs (and py_get_frame, py_get_spectrogram, ...) go through the 
+    same buffers and engines as live data.
+    Coarse windows don't wait for the file's summaries to be built: frame['complete'] is False
+    while parts of the traces are NaN and the PSDs empty, and the browser asks again until it's True.'''
+    debug('in py_replay_window', t0, t1, n_bins)
+
+    f = replay_state['file']
+    if f is None:
+        raise ValueError('No file open, use py_from_file first.')
+    start = max(0, int(t0/f.dt))
+    stop = f.n if t1 is None else min(f.n, int(np.ceil(t1/f.dt)))
+    stop = max(stop, start+2)
+    frame = {'overflow':False, 'streaming':False, 'dropped_samples':0, 'axes_version':-1, 'complete':True}
+    for chan in f.dsets:
+        time, frame[chan+'_min'], frame[chan+'_max'], frame[chan], complete = f.get_envelope(chan, start, stop, n_bins)
+        frame['complete'] &= complete
+        frame.update({k:encode_array(frame[k]) for k in (chan, chan+'_min', chan+'_max')})
+    frame['time'] = encode_array(time, np.float64)
+
+    factor = f.decimation(stop-start, REPLAY_MAX_SAMPLES)
+    if factor >= f.SUMMARY_BLOCK and not all(f.has_summaries(chan, start, stop) for chan in f.dsets):
+        frame['complete'] = False
+        frame['freq'] = frame['psd_A'] = frame['psd_B'] = encode_array(np.zeros(0))
+        return frame
+    if replay_state['loaded'] != (start, stop, factor):
+        with buff_lock:
+            for chan,buff in (('A', buffA), ('B', buffB)):
+                data = f.read_decimated(chan, start, stop, factor) if chan in f.dsets else np.zeros(0)
+                buff.reset(size=max(data.size, 2), dtype=data.dtype if factor == 1 else np.float64)
+                if data.size:
+                    buff.extend(data)
+            axes_cache.update(key=None)
+        replay_state['dt'] = f.dt*factor
+        replay_state['loaded'] = (start, stop, factor)
+        make_psd_engines()
+    psd = update_psd()
+    frame['freq'] = encode_array(psd_engines['A'].freq, np.float64)
+    frame['psd_A'] = encode_array(psd.get('A', np.zeros(0)) if 'A' in f.dsets else np.zeros(0))
+    frame['psd_B'] = encode_array(psd.get('B', np.zeros(0)) if 'B' in f.dsets else np.zeros(0))
+    return frame
 
 
 # Start the Eel application
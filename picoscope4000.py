@@ -1,10 +1,35 @@
 import numpy as np
 import time
+import threading
 
 import ctypes
 from picosdk.ps4000 import ps4000 as ps
 from picosdk.functions import assert_pico_ok
 
+# Trigger types from ps4000Api.h that the picosdk wrapper doesn't define
+THRESHOLD_DIRECTION = {'above':0, 'below':1, 'rising':2, 'falling':3, 'rising_or_falling':4,
+                       # the same values under their window trigger names
+                       'inside':0, 'outside':1, 'enter':2, 'exit':3, 'enter_or_exit':4, 'none':2}
+# ps4000 ratio modes for driver-side downsampling. There is no decimate mode in this API (later 
+# series have one)
+RATIO_MODE = {'none':0, 'aggregate':1, 'average':2}
+TRIGGER_STATE = {'dont_care':0, 'true':1, 'false':2}
+THRESHOLD_MODE = {'level':0, 'window':1}
+MAX_STREAM_SAMPLES = 2**32-1 # the driver's maxSamples is a uint32
+
+class TRIGGER_CONDITIONS(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [('channelA', ctypes.c_int32), ('channelB', ctypes.c_int32),
+                ('channelC', ctypes.c_int32), ('channelD', ctypes.c_int32),
+                ('external', ctypes.c_int32), ('aux', ctypes.c_int32),
+                ('pulseWidthQualifier', ctypes.c_int32)]
+
+class TRIGGER_CHANNEL_PROPERTIES(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [('thresholdUpper', ctypes.c_int16), ('thresholdUpperHysteresis', ctypes.c_uint16),
+                ('thresholdLower', ctypes.c_int16), ('thresholdLowerHysteresis', ctypes.c_uint16),
+                ('channel', ctypes.c_int32), ('thresholdMode', ctypes.c_int32)]
+
 class picoscope4000:
     def __init__(self):
         self.chandle = ctypes.c_int16()
@@ -12,10 +37,33 @@ class picoscope4000:
         self.streaming = False
         self.overflow = False
         self.dt_nanos = None
+        self.downsample_ratio = 1
+        self.ratio_mode = 'none'
+        self.stream_queue = StreamQueue()
+        self.dropped_samples = 0
+        self._lapped = 0 # samples the driver wrote over before we read them, this session
+        self.auto_stop = True # whether the driver stops the stream by itself, see stream_setup
+        self.streamed_samples = 0 # samples the driver handed out this session
+        self.triggers = np.zeros(0, dtype=np.int64)
+        self.buffer_size = channel.BUFFER_ALLOC
+        self.active_buffer = 0
+        self.consumers = []
+        self._acquire_thread = None
+        self._acquire_stop = threading.Event()
+        self.block_running = False
+        self.block_samples = 0
+        self.block_pre_trigger = 0
+        self.block_segment = 0
+        self.n_segments = 1
+        self.n_captures = 0
+        self.segment_overflow = np.zeros(0, dtype=bool)
     def close(self):
         '''Disconnect from the scope'''
+        self.stop_acquisition()
         ps.ps4000CloseUnit(self.chandle)
+        consumers = self.consumers
         self.__init__()
+        self.consumers = consumers # keep subscriptions across reconnects
     def connect(self):
         '''Connect to the scope'''
         # Open PicoScope 4000 Series device
@@ -24,10 +72,21 @@ class picoscope4000:
     def set_channel(self, chan:str, enable:bool, rng:float, coupling:str):
         '''Set channels on the picoscope.'''
         self.channels[chan].set(rng=rng, coupling=coupling, enable=enable)
-    def stream_setup(self, duration:float, dt:float):
+    def stream_setup(self, duration:float, dt:float, latency:float=None, n_buffers:int=3, 
+                     downsample_ratio:int=1, ratio_mode:str='aggregate'):
         '''Setup parameters for streaming. 
-        duration: The time in seconds to stream
+        duration: The time in seconds to stream. Streams of more than MAX_STREAM_SAMPLES samples are stopped
+            by publish_latest (so only while the acquisition thread or someone else polls) instead of the driver.
         dt: ESTIMATED the sampling interval, a float in seconds. The picoscope SDK will round this down to the nearest 100 ns. 
+        latency: If given, the longest time in seconds expected between polls of the driver. The driver 
+            buffers are then sized to hold that much data and a pool of n_buffers of them is rotated, 
+            so consumers keep the filled ones while the driver writes into the next. If None, a single 
+            channel.BUFFER_ALLOC sized buffer per channel is registered for the whole stream.
+        downsample_ratio: If more than 1, the driver reduces every downsample_ratio samples to one 
+            before they reach python, by ratio_mode 'average' (their mean) or 'aggregate' (their min 
+            and max, the max coming out under the channel name and the min under e.g. 'A_min' in 
+            get_latest_streamed_views). The ps4000 API has no 'decimate' mode. Buffer sizes, the
+            samples handed out and get_dt() are all in downsampled samples then.
         picoscope4000.get_dt() will give the real dt after this function has been called.
         NOTE: The picoscope 4262 only accepts multiples of 100 ns, and for 
         two-channel acquisition, it can do 100 ns for only about a second.
@@ -35,45 +94,75 @@ class picoscope4000:
         # Begin streaming mode:
         if self.streaming:
             raise ValueError('Already streaming!')
+        if ratio_mode not in RATIO_MODE:
+            raise ValueError(f'Invalid ratio mode {ratio_mode}. Should be one of {tuple(RATIO_MODE)} (ps4000 cannot decimate).')
+        downsample_ratio = max(1, int(downsample_ratio))
+        if ratio_mode == 'none' and downsample_ratio > 1:
+            raise ValueError(f'Downsampling by {downsample_ratio} needs a ratio mode other than none.')
+        self.downsample_ratio = downsample_ratio
+        self.ratio_mode = ratio_mode if downsample_ratio > 1 else 'none'
+        self.reset_segments()
         self.streaming = True
         self.overflow = False
     
         self.totalSamples = int( np.round( duration/dt ) )
+        # The driver takes the number of samples as a uint32 and silently wraps anything longer
+        # (an hour at 10 MS/s would stop after 164 s), so longer streams run without autoStop
+        # and publish_latest stops them once that many samples have come in.
+        self.auto_stop = self.totalSamples <= MAX_STREAM_SAMPLES
+        self.streamed_samples = 0
 
         sampleUnits = ps.PS4000_TIME_UNITS['PS4000_NS']
         self.sampleInterval = ctypes.c_int32(int(np.round(dt*1e9))) #must be more than 150 nanoseconds in two-channel mode...?
         # maybe even more than 200 ns? It works at 100 ns for about a second. Also, it seems this will round down to the nearest 100 ns.
     
+        if latency is None:
+            self.buffer_size, n_buffers = channel.BUFFER_ALLOC, 1
+        else:
+            self.buffer_size = int(min(max(np.ceil(latency/(dt*downsample_ratio)), 1000), channel.BUFFER_ALLOC))
+        self.active_buffer = 0
         for _,ch in self.channels.items():
-            ch.buffer_initialize()
+            ch.buffer_initialize(self.buffer_size, n_buffers, aggregate=self.ratio_mode == 'aggregate')
 
         # We are not triggering:
         maxPreTriggerSamples = 0
-        autoStopOn = 1
-        # No downsampling:
-        downsampleRatio = 1
-
-        assert_pico_ok( ps.ps4000RunStreaming(self.chandle,
-            ctypes.byref(self.sampleInterval),
-            sampleUnits,
-            maxPreTriggerSamples,
-            self.totalSamples,
-            autoStopOn,
-            downsampleRatio,
-            min(self.totalSamples, channel.BUFFER_ALLOC)))
+        autoStopOn = int(self.auto_stop)
+        maxSamples = min(self.totalSamples, MAX_STREAM_SAMPLES)
+
+        if self.ratio_mode == 'none':
+            assert_pico_ok( ps.ps4000RunStreaming(self.chandle,
+                ctypes.byref(self.sampleInterval),
+                sampleUnits,
+                maxPreTriggerSamples,
+                maxSamples,
+                autoStopOn,
+                1,
+                min(maxSamples, self.buffer_size)))
+        else:
+            assert_pico_ok( ps.ps4000RunStreamingEx(self.chandle,
+                ctypes.byref(self.sampleInterval),
+                sampleUnits,
+                maxPreTriggerSamples,
+                maxSamples, # in raw samples
+                autoStopOn,
+                downsample_ratio,
+                RATIO_MODE[self.ratio_mode],
+                min(maxSamples//downsample_ratio, self.buffer_size))) # in downsampled samples
         self.dt_nanos = self.sampleInterval.value # THIS LINE HAS TO COME AFTER ps4000RunStreaming(...).
     
         def _callback(handle, noOfSamples, buff_start_idx, overflow, triggerAt, triggered, autoStop, param):
             if autoStop:
                 self.streaming = False
                 self.stop()
-            self.buffer_start = buff_start_idx
-            self.buffer_end = buff_start_idx + noOfSamples
-            self.overflow = (overflow != 0)
+            # The driver can call this several times per ps4000GetStreamingLatestValues, so queue
+            # every chunk instead of overwriting, the consumer drains them all later.
+            self.stream_queue.put(buff_start_idx, noOfSamples, overflow,
+                                  buff_start_idx + triggerAt if triggered else -1, self.active_buffer)
         # Convert the python function into a C function pointer.
         self.cFuncPtr = ps.StreamingReadyType( _callback )
-        self.buffer_start = 0
-        self.buffer_end = 0
+        self.stream_queue = StreamQueue()
+        self.dropped_samples = 0
+        self._lapped = 0
     def stream_latest(self):
         '''Call this to put the latest streamed data into the buffers. Must be called after stream_setup has been called.'''
         if not self.streaming:
@@ -81,20 +170,329 @@ class picoscope4000:
         if self.overflow:
             print(f'WARNING! Buffer overflowed or channel out of range!')
         ps.ps4000GetStreamingLatestValues(self.chandle, self.cFuncPtr, None)
-    def get_latest_streamed_data(self) ->dict[str,np.ndarray]:
-        '''returns a dict with numpy arrays corresponding to the latest data that has been streamed.'''
-        idx = np.arange(self.buffer_start, self.buffer_end) % channel.BUFFER_ALLOC
-        res = {k:ch.ring_buffer[idx] for k,ch in self.channels.items()}
-        # NOTE to self: not putting this here made a non-obvious bug
-        #  based on just how quickly data was taken out, wasted so much time
-        self.buffer_start = self.buffer_end%channel.BUFFER_ALLOC
+    def get_latest_streamed_views(self) ->dict[str,tuple[np.ndarray,...]]:
+        '''Like get_latest_streamed_data, but without copying. Returns a dict with, for each channel, 
+        a tuple of contiguous views into the driver buffers, oldest first: at most two (head, then 
+        wrapped tail) per pool buffer written since the last call. With a single buffer the views are
+        only valid until the next stream_latest call, when the driver may overwrite them; with a pool,
+        until the pool comes back around to the buffer (see swap_buffers).'''
+        recs = self.stream_queue.drain()
+        self.streamed_samples += int(recs['count'].sum())
+        self.overflow = bool(recs['overflow'].any())
+        self.triggers = recs['trigger_at'][recs['trigger_at'] >= 0]
+        res = {k:() for k in self.channels}
+        # The chunks written into the same pool buffer are consecutive, so each run of them
+        # collapses into a single range.
+        runs = np.flatnonzero(np.diff(recs['buffer'])) + 1
+        for run in np.split(recs, runs) if len(recs) else ():
+            start = int(run['start'][0])
+            n = int(run['count'].sum())
+            if n > self.buffer_size:
+                # the driver lapped us and wrote over the oldest samples before we got to them
+                self._lapped += n - self.buffer_size
+                start += n - self.buffer_size
+                n = self.buffer_size
+            for k,ch in self.channels.items():
+                res[k] += ch.ring_slices(start, n, int(run['buffer'][0]))
+                if ch.min_pool:
+                    res[k+'_min'] = res.get(k+'_min', ()) + ch.ring_slices(start, n, int(run['buffer'][0]), minimum=True)
+        dropped = self.stream_queue.dropped + self._lapped
+        if dropped > self.dropped_samples:
+            print(f'WARNING! {dropped-self.dropped_samples} samples dropped ({dropped} this session)!')
+            self.dropped_samples = dropped
+        return res
+    def swap_buffers(self):
+        '''Register the next buffer of the pool with the driver, so that views of the current one
+        stay untouched until the pool comes back around to it. Does nothing with a single buffer.'''
+        n_buffers = len(self.channels['A'].buffer_pool)
+        if n_buffers > 1:
+            self.active_buffer = (self.active_buffer + 1)%n_buffers
+            for _,ch in self.channels.items():
+                ch.register_buffer(self.active_buffer)
+    def get_latest_streamed_data(self, out:dict[str,np.ndarray]=None) ->dict[str,np.ndarray]:
+        '''returns a dict with numpy arrays corresponding to the latest data that has been streamed.
+        If out is given (a dict of int16 arrays keyed by channel), the data is copied straight into
+        the start of those arrays and views of the filled part are returned, so nothing is allocated.'''
+        res = {}
+        for k,slcs in self.get_latest_streamed_views().items():
+            n = sum(s.size for s in slcs)
+            if out is None or k not in out:
+                res[k] = np.concatenate(slcs) if slcs else np.zeros(0, dtype=np.int16)
+                continue
+            if n > out[k].size:
+                raise IndexError(f'Output buffer for channel {k} not large enough!')
+            i = 0
+            for s in slcs:
+                out[k][i:i+s.size] = s
+                i += s.size
+            res[k] = out[k][:n]
         return res
+    def subscribe(self, consumer):
+        '''Register consumer(views) to be called with the output of get_latest_streamed_views
+        every time the acquisition thread drains the driver. It runs on the acquisition thread and
+        the views are only valid during the call, so copy out whatever is needed and return quickly.'''
+        if consumer not in self.consumers:
+            self.consumers.append(consumer)
+    def unsubscribe(self, consumer):
+        if consumer in self.consumers:
+            self.consumers.remove(consumer)
+    def publish_latest(self):
+        '''Poll the driver once and hand whatever arrived to all the consumers.'''
+        self.stream_latest()
+        views = self.get_latest_streamed_views()
+        if any(len(v) for v in views.values()):
+            self.swap_buffers() # before publishing, so the driver never writes into what consumers are reading
+        if not self.auto_stop and (self.streamed_samples + self.stream_queue.dropped)*self.downsample_ratio >= self.totalSamples:
+            self.stop() # before publishing too, so consumers see that this is the last of it
+        for consumer in list(self.consumers): # consumers may unsubscribe themselves
+            consumer(views)
+    def start_acquisition(self, interval:float=0.01):
+        '''Start a thread that polls the driver every interval seconds and publishes to the
+        consumers, so the poll cadence no longer depends on how fast anyone plots.
+        Must be called after stream_setup; the thread exits on its own when streaming stops.'''
+        if not self.streaming:
+            raise ValueError('Not currently streaming!')
+        self.stop_acquisition()
+        self._acquire_stop.clear()
+        def _acquire():
+            try:
+                while self.streaming and not self._acquire_stop.is_set():
+                    self.publish_latest()
+                    self._acquire_stop.wait(interval)
+            except Exception as e:
+                print('ERROR in acquisition thread!', e)
+                self.stop() # the driver would keep streaming otherwise, and the next stream_setup would fail
+        self._acquire_thread = threading.Thread(target=_acquire, name='picoscope4000 acquisition', daemon=True)
+        self._acquire_thread.start()
+    def stop_acquisition(self):
+        self._acquire_stop.set()
+        thread = self._acquire_thread
+        # stop() can be called from the streaming callback, which runs on the acquisition thread itself
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+            self._acquire_thread = None
+    def is_acquiring(self)->bool:
+        return self._acquire_thread is not None and self._acquire_thread.is_alive()
+    def set_simple_trigger(self, chan:str, threshold:float, direction:str='rising', delay:int=0, auto_trigger_ms:int=0):
+        '''Trigger block captures when channel chan crosses threshold (in volts, so set the channel
+        range first) in direction (see THRESHOLD_DIRECTION). delay is in samples after the trigger,
+        and if auto_trigger_ms is nonzero the scope triggers by itself after that long.'''
+        assert_pico_ok( ps.ps4000SetSimpleTrigger(self.chandle, 1, self.channels[chan]._chan(),
+            self.channels[chan].volts_to_adc(threshold), THRESHOLD_DIRECTION[direction], delay, auto_trigger_ms) )
+    def set_advanced_trigger(self, conditions:list[dict], directions:dict, properties:dict, auto_trigger_ms:int=0):
+        '''Advanced triggering. 
+        conditions: list of {chan:'true'/'false'}, the channels in one dict are ANDed and the dicts ORed.
+            Channels left out don't matter.
+        directions: {chan:direction} (see THRESHOLD_DIRECTION), the others are 'none'.
+        properties: {chan:{'upper':volts, 'lower':volts, 'hysteresis':volts, 'mode':'level' or 'window'}},
+            lower and hysteresis being optional. In level mode only upper is used.'''
+        conds = (TRIGGER_CONDITIONS*len(conditions))(*[
+            TRIGGER_CONDITIONS(channelA=TRIGGER_STATE[c.get('A', 'dont_care')], channelB=TRIGGER_STATE[c.get('B', 'dont_care')])
+            for c in conditions])
+        props = []
+        for chan,p in properties.items():
+            ch = self.channels[chan]
+            hyst = abs(ch.volts_to_adc(p.get('hysteresis', 0)))
+            props.append(TRIGGER_CHANNEL_PROPERTIES(ch.volts_to_adc(p['upper']), hyst,
+                ch.volts_to_adc(p.get('lower', p['upper'])), hyst, ch._chan(), THRESHOLD_MODE[p.get('mode', 'level')]))
+        props = (TRIGGER_CHANNEL_PROPERTIES*len(props))(*props)
+        none = THRESHOLD_DIRECTION['none']
+        assert_pico_ok( ps.ps4000SetTriggerChannelConditions(self.chandle, ctypes.byref(conds), len(conditions)) )
+        assert_pico_ok( ps.ps4000SetTriggerChannelDirections(self.chandle,
+            THRESHOLD_DIRECTION[directions.get('A', 'none')], THRESHOLD_DIRECTION[directions.get('B', 'none')],
+            none, none, none, none) )
+        assert_pico_ok( ps.ps4000SetTriggerChannelProperties(self.chandle, ctypes.byref(props), len(props), 0, auto_trigger_ms) )
+    def disable_trigger(self):
+        assert_pico_ok( ps.ps4000SetSimpleTrigger(self.chandle, 0, self.channels['A']._chan(), 0,
+            THRESHOLD_DIRECTION['rising'], 0, 0) )
+    def get_timebase(self, dt:float, n_samples:int, segment:int=0)->tuple[int,float]:
+        '''The timebase for block mode with the longest sampling interval not above dt (or the shortest
+        possible one, if dt is shorter than that) and that interval in seconds. Timebases map to intervals
+        differently per model, so ask the driver (ps4000GetTimebase2) and bisect.'''
+        def interval(timebase:int):
+            ns, max_samples = ctypes.c_float(), ctypes.c_int32()
+            status = ps.ps4000GetTimebase2(self.chandle, timebase, n_samples, ctypes.byref(ns), 0,
+                                           ctypes.byref(max_samples), segment)
+            return status, ns.value
+        # smallest valid timebase with an interval above dt. Invalid ones are the too-fast ones
+        lo, hi = 0, 2**31
+        while lo < hi:
+            mid = (lo + hi)//2
+            status, ns = interval(mid)
+            if status == 0 and ns > dt*1e9*(1+1e-9):
+                hi = mid
+            else:
+                lo = mid + 1
+        for timebase in (lo-1, lo):
+            status, ns = interval(timebase) if timebase >= 0 else (None, 0)
+            if status == 0:
+                return timebase, ns*1e-9
+        assert_pico_ok(status) # nothing valid, e.g. n_samples doesn't fit in memory
+    def block_setup(self, dt:float, n_samples:int, pre_trigger:int=0, segment:int=0)->float:
+        '''Start a block capture of n_samples per enabled channel, of which pre_trigger are from 
+        before the trigger (see set_simple_trigger and set_advanced_trigger, or disable_trigger to 
+        capture right away). Returns the real dt, the driver only has a discrete set of them. 
+        get_block waits for the capture and returns the samples.'''
+        if self.streaming:
+            raise ValueError('Already streaming!')
+        if not 0 <= pre_trigger <= n_samples:
+            raise ValueError(f'pre_trigger must be between 0 and n_samples ({n_samples}), not {pre_trigger}')
+        if segment == 0:
+            self.reset_segments()
+        timebase, dt = self.get_timebase(dt, n_samples, segment)
+        for _,ch in self.channels.items():
+            if ch.enabled:
+                ch.block_buffer_initialize(n_samples)
+        time_indisposed_ms = ctypes.c_int32()
+        assert_pico_ok( ps.ps4000RunBlock(self.chandle, pre_trigger, n_samples-pre_trigger, timebase, 0,
+            ctypes.byref(time_indisposed_ms), segment, None, None) )
+        self.dt_nanos = dt*1e9
+        self.downsample_ratio = 1
+        self.block_running = True
+        self.block_samples = n_samples
+        self.block_pre_trigger = pre_trigger
+        self.block_segment = segment
+        return dt
+    def is_block_ready(self)->bool:
+        ready = ctypes.c_int16()
+        assert_pico_ok( ps.ps4000IsReady(self.chandle, ctypes.byref(ready)) )
+        return bool(ready.value)
+    def wait_block(self, timeout:float=None, poll_interval:float=0.001):
+        '''Wait for the running (rapid) block capture, stopping it and raising TimeoutError after timeout seconds.'''
+        if not self.block_running:
+            raise ValueError('No block capture running!')
+        t0 = time.time()
+        while not self.is_block_ready():
+            if timeout is not None and time.time()-t0 > timeout:
+                self.stop()
+                raise TimeoutError(f'No trigger within {timeout} s.')
+            time.sleep(poll_interval)
+    def get_block(self, timeout:float=None, poll_interval:float=0.001)->dict[str,np.ndarray]:
+        '''Wait (up to timeout seconds, if given) for the capture started by block_setup and return 
+        the int16 samples per enabled channel. The driver copies straight into the arrays returned,
+        which the next capture reuses, so copy them to keep them. The trigger is at index block_pre_trigger.'''
+        self.wait_block(timeout, poll_interval)
+        n = ctypes.c_uint32(self.block_samples)
+        overflow = ctypes.c_int16()
+        assert_pico_ok( ps.ps4000GetValues(self.chandle, 0, ctypes.byref(n), 1, 0, self.block_segment,
+                                           ctypes.byref(overflow)) )
+        self.block_running = False
+        self.overflow = bool(overflow.value)
+        return {k:ch.block_buffer[:n.value] for k,ch in self.channels.items() if ch.enabled}
+    def capture_block(self, dt:float, n_samples:int, pre_trigger:int=0, timeout:float=None)->dict[str,np.ndarray]:
+        '''block_setup and get_block in one go.'''
+        self.block_setup(dt, n_samples, pre_trigger)
+        return self.get_block(timeout)
+    def set_segments(self, n_segments:int)->int:
+        '''Split the scope's memory into n_segments, returns how many samples fit in each.'''
+        max_samples = ctypes.c_int32()
+        assert_pico_ok( ps.ps4000MemorySegments(self.chandle, n_segments, ctypes.byref(max_samples)) )
+        self.n_segments = n_segments
+        return max_samples.value
+    def reset_segments(self):
+        '''Back to one segment and one capture per run after rapid block mode.'''
+        if self.n_segments != 1 or self.n_captures > 1:
+            self.set_segments(1)
+            assert_pico_ok( ps.ps4000SetNoOfCaptures(self.chandle, 1) )
+            self.n_captures = 1
+    def rapid_block_setup(self, dt:float, n_samples:int, n_captures:int, pre_trigger:int=0)->float:
+        '''Start a rapid block capture: the scope rearms itself after every trigger and keeps 
+        n_captures blocks of n_samples (pre_trigger of them from before the trigger) in as many memory
+        segments, without any round trip to python in between. Returns the real dt.
+        get_rapid_block waits for all of them and fetches them in one bulk call.'''
+        if self.streaming:
+            raise ValueError('Already streaming!')
+        if not 0 <= pre_trigger <= n_samples:
+            raise ValueError(f'pre_trigger must be between 0 and n_samples ({n_samples}), not {pre_trigger}')
+        max_samples = self.set_segments(n_captures)
+        if n_samples > max_samples:
+            raise ValueError(f'Only {max_samples} samples fit in each of {n_captures} segments, not {n_samples}.')
+        assert_pico_ok( ps.ps4000SetNoOfCaptures(self.chandle, n_captures) )
+        timebase, dt = self.get_timebase(dt, n_samples)
+        for _,ch in self.channels.items():
+            if ch.enabled:
+                ch.bulk_buffer_initialize(n_captures, n_samples)
+        time_indisposed_ms = ctypes.c_int32()
+        assert_pico_ok( ps.ps4000RunBlock(self.chandle, pre_trigger, n_samples-pre_trigger, timebase, 0,
+            ctypes.byref(time_indisposed_ms), 0, None, None) )
+        self.dt_nanos = dt*1e9
+        self.downsample_ratio = 1
+        self.block_running = True
+        self.block_samples = n_samples
+        self.block_pre_trigger = pre_trigger
+        self.n_captures = n_captures
+        return dt
+    def get_rapid_block(self, timeout:float=None, poll_interval:float=0.001)->tuple[dict[str,np.ndarray],np.ndarray]:
+        '''Wait for the rapid block capture and fetch every segment with ps4000GetValuesBulk.
+        Returns ({chan:n_captures x n_samples int16 array}, trigger time offsets in seconds). Each row's
+        trigger is at index block_pre_trigger, and its offset is the time from the trigger to that sample
+        (ps4000 has sub-sample trigger timing, but no absolute per-segment timestamps). Per-segment 
+        overflow flags end up in segment_overflow. Like get_block, the arrays are reused by the next capture.'''
+        self.wait_block(timeout, poll_interval)
+        n = ctypes.c_uint32(self.block_samples)
+        overflow = (ctypes.c_int16*self.n_captures)()
+        assert_pico_ok( ps.ps4000GetValuesBulk(self.chandle, ctypes.byref(n), 0, self.n_captures-1, overflow) )
+        times = np.zeros(self.n_captures, dtype=np.int64)
+        units = np.zeros(self.n_captures, dtype=np.int32)
+        assert_pico_ok( ps.ps4000GetValuesTriggerTimeOffsetBulk64(self.chandle,
+            times.ctypes.data_as(ctypes.POINTER(ctypes.c_int64)), units.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+            0, self.n_captures-1) )
+        self.block_running = False
+        self.segment_overflow = np.array(overflow, dtype=bool)
+        self.overflow = bool(self.segment_overflow.any())
+        # PS4000_TIME_UNITS go from femtoseconds (0) to seconds (5) in steps of 1000
+        offsets = times*10.**(3*units - 15)
+        return {k:ch.bulk_buffer[:, :n.value] for k,ch in self.channels.items() if ch.enabled}, offsets
+    def capture_rapid_block(self, dt:float, n_samples:int, n_captures:int, pre_trigger:int=0,
+                            timeout:float=None)->tuple[dict[str,np.ndarray],np.ndarray]:
+        '''rapid_block_setup and get_rapid_block in one go.'''
+        self.rapid_block_setup(dt, n_samples, n_captures, pre_trigger)
+        return self.get_rapid_block(timeout)
     def stop(self):
         # Stop the scope
-        ps.ps4000Stop(self.chandle)
         self.streaming = False
+        self.block_running = False
+        self.stop_acquisition()
+        ps.ps4000Stop(self.chandle)
     def get_dt(self)->float:
-        return self.dt_nanos*1e-9
+        '''Time between the samples handed out, so including any downsampling.'''
+        return self.dt_nanos*self.downsample_ratio*1e-9
+
+
+class StreamQueue:
+    '''Preallocated queue of the (start, count, overflow, trigger) records handed to the streaming 
+    callback. The callback is the only producer and the consumer is the only one draining, so the 
+    write and read counters each have a single writer and no lock is needed: a record is written
+    in full before head is bumped to publish it. If the consumer falls so far behind that the
+    queue fills up, the records are discarded and their samples added to dropped.'''
+    RECORD = np.dtype([('start', np.int64), ('count', np.int64),
+                       ('overflow', np.bool_), ('trigger_at', np.int64), ('buffer', np.int16)])
+    def __init__(self, size:int=4096):
+        self.records = np.zeros(size, dtype=StreamQueue.RECORD)
+        self.head = 0 # total records written, only touched by put
+        self.tail = 0 # total records read, only touched by drain
+        self.dropped = 0
+    def __len__(self):
+        return self.head - self.tail
+    def put(self, start:int, count:int, overflow:int, trigger_at:int=-1, buffer:int=0)->bool:
+        if self.head - self.tail >= self.records.size:
+            self.dropped += count
+            return False
+        self.records[self.head%self.records.size] = (start, count, overflow != 0, trigger_at, buffer)
+        self.head += 1
+        return True
+    def drain(self)->np.ndarray:
+        '''Returns a copy of all the records published so far, oldest first.'''
+        head = self.head
+        i, j = self.tail%self.records.size, head%self.records.size
+        if head - self.tail == 0:
+            res = self.records[:0].copy()
+        elif i < j:
+            res = self.records[i:j].copy()
+        else:
+            res = np.concatenate((self.records[i:], self.records[:j]))
+        self.tail = head
+        return res
 
 
 class channel:
@@ -114,6 +512,11 @@ class channel:
         self.coupling = None
         self.enabled = None
         self.chan = chan
+        self.block_buffer = None
+        self.bulk_buffer = None
+        self.buffer_pool = []
+        self.min_pool = []
+        self.registered = 0
     def _chan(self):
         return ps.PS4000_CHANNEL[f'PS4000_CHANNEL_{self.chan}']
     def _rng(self):
@@ -164,15 +567,20 @@ class channel:
             self._enabled(),
             self._coupling(),
             self._rng()) )
-    def buffer_initialize(self):
-        '''Need two buffers here. 
-            One is the ring buffer used by the picoscope, but it is capped at ~1e6 points.
-            The other is for the arbitrary length of data acquired while streaming, which will be
-            filled from the first buffer.'''
-        self.ring_buffer = np.zeros(shape=channel.BUFFER_ALLOC, dtype=np.int16)
-        # if channel.BUFFER_ALLOC < totalSamples:
-        # else:
-        #     self.ring_buffer = np.zeros(shape=totalSamples, dtype=np.int16)
+    def buffer_initialize(self, size:int=None, n_buffers:int=1, aggregate:bool=False):
+        '''Allocate the pool of n_buffers driver buffers of size samples each and register the first.
+            The driver writes into whichever is registered, and the data is copied out of it into the
+            buffers of arbitrary length (see Buffer.py) that hold what was acquired while streaming.
+            With aggregate downsampling there is a second pool for the minima, the first holding the maxima.'''
+        if size is None:
+            size = channel.BUFFER_ALLOC
+        self.buffer_pool = [np.zeros(shape=size, dtype=np.int16) for _ in range(n_buffers)]
+        self.min_pool = [np.zeros(shape=size, dtype=np.int16) for _ in range(n_buffers)] if aggregate else []
+        self.register_buffer(0)
+    def register_buffer(self, i:int):
+        '''Point the driver at buffer i of the pool.'''
+        self.ring_buffer = self.buffer_pool[i]
+        self.registered = i
         # Set data buffer location for data collection
         # handle = chandle
         # source = PS4000_CHANNEL_A  or B
@@ -181,18 +589,54 @@ class channel:
         # buffer length = maxSamples
         # segment index = 0 ???
         # ratio mode = PS4000_RATIO_MODE_NONE = 0
+        # the min buffer is only used when aggregating, the max one being the only one otherwise
         assert_pico_ok( ps.ps4000SetDataBuffers(
             self.parent_scope.chandle,
             self._chan(),
             self.ring_buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
+            self.min_pool[i].ctypes.data_as(ctypes.POINTER(ctypes.c_int16)) if self.min_pool else None,
+            self.ring_buffer.size) )
+    def block_buffer_initialize(self, size:int):
+        '''Allocate (or reuse, if it's big enough) the buffer block captures are copied into and register it.'''
+        if self.block_buffer is None or self.block_buffer.size < size:
+            self.block_buffer = np.zeros(shape=size, dtype=np.int16)
+        assert_pico_ok( ps.ps4000SetDataBuffers(
+            self.parent_scope.chandle,
+            self._chan(),
+            self.block_buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
             None,
-            channel.BUFFER_ALLOC) )
-                
-        # We need a big buffer, not registered with the driver, to keep our complete capture in.
+            size) )
+    def bulk_buffer_initialize(self, n_captures:int, size:int):
+        '''Allocate (or reuse) the n_captures x size array rapid block captures are copied into and
+        register each row as the buffer of its memory segment.'''
+        if self.bulk_buffer is None or self.bulk_buffer.shape != (n_captures, size):
+            self.bulk_buffer = np.zeros(shape=(n_captures, size), dtype=np.int16)
+        for i in range(n_captures):
+            assert_pico_ok( ps.ps4000SetDataBufferBulk(
+                self.parent_scope.chandle,
+                self._chan(),
+                self.bulk_buffer[i].ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
+                size,
+                i) )
+    def ring_slices(self, start:int, n:int, i:int=None, minimum:bool=False) ->tuple[np.ndarray,...]:
+        '''Returns n samples of buffer i of the pool (default: the registered one) starting at start as 
+        at most two contiguous views, the second one being the part that wrapped around to the beginning.
+        minimum picks the pool of minima when aggregating.'''
+        if i is None:
+            i = self.registered
+        buff = (self.min_pool if minimum else self.buffer_pool)[i]
+        start = start%buff.size
+        n = min(n, buff.size)
+        if start + n <= buff.size:
+            return (buff[start:start+n],)
+        return (buff[start:], buff[:start+n-buff.size])
     def get_volt_range(self):
         return self.rng
     def get_volt_scale(self):
         return self.get_volt_range()/channel.MAX_ADC
+    def volts_to_adc(self, volts:float)->int:
+        '''Volts to ADC counts in the current range, e.g. for trigger thresholds.'''
+        return int(np.clip(np.round(volts/self.get_volt_scale()), -channel.MAX_ADC, channel.MAX_ADC))
 
 
 if __name__ == '__main__':
@@ -1,57 +1,45 @@
 async function fetchDirectoryStructure() {
+    // only the top level is fetched here, deeper levels are asked for when they are expanded
     try {
-        const treeData = buildTreeData( await eel.py_get_dir_structure()() );
-        displayDirectoryStructure(treeData);
+        const directoryList = document.getElementById('directoryList');
+        directoryList.innerHTML = ''; // Clear previous directory list
+        const ul = await buildLevel('');
+        directoryList.appendChild(ul);
+        ul.firstChild.click(); // select (and expand) the first element
     } catch (error) {
         console.error('Error fetching directory structure:', error);
     }
 }
 
-function buildTreeData(paths) {
-    const tree = {};
-    paths.forEach(path => {
-        const parts = path.split('\\')
-        // parts.splice(0,1);
-        let current = tree;
-        parts.forEach((part, index) => {
-            if (!current[part]) {
-                current[part] = index === parts.length - 1 ? null : {};
-            }
-            current = current[part];
-        });
-    });
-    return tree;
-}
-
-function displayDirectoryStructure(treeData) {
-    const directoryList = document.getElementById('directoryList');
-    directoryList.innerHTML = ''; // Clear previous directory list
-
-    const tree = buildTree(treeData);
-    directoryList.appendChild(tree);
-}
-
-function buildTree(treeData, parentPath = '') {
+async function buildLevel(parentPath) {
     const ul = document.createElement('ul');
-    Object.keys(treeData).forEach(key => {
+    const children = await eel.py_get_dir_children(parentPath)();
+    children.forEach(child => {
         const li = document.createElement('li');
-        const fullPath = parentPath ? `${parentPath}/${key}` : key;
-        li.textContent = key;
-        li.className = 'collapsed unselected';
-        li.onclick = (event) => {
+        const fullPath = parentPath ? `${parentPath}/${child.name}` : child.name;
+        li.textContent = child.name;
+        // has_children is null when python hasn't listed that directory yet, assume it might
+        li.className = (child.has_children === false ? 'leaf' : 'collapsed') + ' unselected';
+        li.onclick = async (event) => {
             event.stopPropagation();
-            toggleExpandCollapse(li);
             handleDirectorySelection(li, fullPath);
+            if (li.classList.contains('leaf')) {
+                return;
+            }
+            if (!li.dataset.loaded) {
+                li.dataset.loaded = 'true';
+                const childUl = await buildLevel(fullPath);
+                if (!childUl.children.length) {
+                    li.classList.remove('collapsed');
+                    li.classList.add('leaf');
+                    return;
+                }
+                li.appendChild(childUl);
+            }
+            toggleExpandCollapse(li);
         };
-        if (treeData[key] !== null) {
-            const childUl = buildTree(treeData[key], fullPath);
-            li.appendChild(childUl);
-        }
         ul.appendChild(li);
     });
-    if (!parentPath) {
-        ul.firstChild.click(); // select the first element
-    }
     return ul;
 }
 
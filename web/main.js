@@ -8,6 +8,21 @@ function get_float(id) {
 function get_int(id) {
     return parseInt(document.getElementById(id).value)
 }
+const TYPED_ARRAYS = {float32: Float32Array, float64: Float64Array, int16: Int16Array, uint8: Uint8Array};
+async function decode_array(obj) {
+    // inverse of encode_array in eel_main.py: base64 of raw little-endian bytes -> typed array.
+    // Going through fetch lets the browser decode the base64 natively.
+    const response = await fetch('data:application/octet-stream;base64,' + obj.b64);
+    return new TYPED_ARRAYS[obj.dtype](await response.arrayBuffer());
+}
+async function decode_arrays(obj) {
+    // decode every encoded array in a dict returned by python
+    let res = {};
+    for (const key in obj) {
+        res[key] = (obj[key] && obj[key].b64 !== undefined) ? await decode_array(obj[key]) : obj[key];
+    }
+    return res;
+}
 function startProgressBar(duration) {
     let progressBar = document.getElementById('progressBar');
     progressBar.textContent = ''
@@ -87,6 +102,18 @@ async function save_buff(binsize) {
         let suffix = document.getElementById('file-suffix').value
 
         let msg = await eel.py_save_buff(dir, suffix, binsize)();
+        if (msg[0]) {
+            // python saves in the background, follow it on the progress bar
+            let progressBar = document.getElementById('progressBar');
+            let status = await eel.py_get_save_progress()();
+            while (!status.finished) {
+                progressBar.style.width = parseInt(status.progress*100) + '%';
+                await sleep(100);
+                status = await eel.py_get_save_progress()();
+            }
+            progressBar.style.width = '100%';
+            msg = status.msg;
+        }
         
         console.log(msg)
         document.getElementById('toast-title').innerHTML = msg[1]
@@ -108,27 +135,99 @@ async function save_buff(binsize) {
 
 function clear_plots() {
     console.log('Clearing plots does not actually clear data')
-    Plotly.update("plotAtime", {x:[[]], y:[[]]}, {}, [0]);
+    Plotly.update("plotAtime", {x:[[],[],[]], y:[[],[],[]]}, {}, [0,1,2]);
     Plotly.update("plotAfreq", {x:[[]], y:[[]]}, {}, [0]);
-    Plotly.update("plotBtime", {x:[[]], y:[[]]}, {}, [0]);
+    Plotly.update("plotBtime", {x:[[],[],[]], y:[[],[],[]]}, {}, [0,1,2]);
     Plotly.update("plotBfreq", {x:[[]], y:[[]]}, {}, [0]);
 }
 async function plot() {
+    // one round trip for everything, all from the same snapshot of the buffers
     let binsize = get_int('binsize');
     if (!binsize) {
         binsize = 1;
     }
-    let x_data = await eel.py_get_x_data(binsize)();
-    let time_data = await eel.py_get_buff_data(binsize)();
-    let freq_data = await eel.py_get_psd(binsize)();
-
+    let frame = await decode_arrays(await eel.py_get_frame(binsize, {axes_version: axes.version})());
+    draw_frame(frame);
+    if (document.getElementById('waterfall-enable').checked) {
+        await draw_spectrogram();
+    }
+    return frame;
+}
+async function draw_spectrogram() {
+    // waterfall of each enabled channel, the uint8 image is mapped back to dB on the colorbar
+    let specs = await eel.py_get_spectrogram()();
+    for (const chan in specs) {
+        if (!document.getElementById(chan+'-enable').checked) {
+            continue;
+        }
+        let spec = await decode_arrays(specs[chan]);
+        let z = [];
+        for (let i = 0; i < spec.rows; i++) {
+            z.push(spec.image.subarray(i*spec.cols, (i+1)*spec.cols));
+        }
+        let ticks = [0, 64, 128, 192, 255];
+        Plotly.react('plot'+chan+'spec', [{z:z, x:spec.freq, y:spec.time, type:'heatmap', zmin:0, zmax:255,
+            colorscale:'Viridis', colorbar:{tickvals:ticks, title:{text:'dB'},
+                ticktext:ticks.map(t => (spec.db_min + t/255*(spec.db_max-spec.db_min)).toFixed(0))}}],
+            layout_spec);
+    }
+}
+function draw_frame(frame) {
+    // python only sends the axes when they changed since the version we hold
+    if (frame.time !== undefined) {
+        axes = {version: frame.axes_version, time: frame.time, freq: frame.freq};
+    }
+    frame.time = axes.time;
+    frame.freq = axes.freq;
     if (document.getElementById('A-enable').checked) {
-        Plotly.update("plotAtime", {x:[x_data.time], y:[time_data.A]}, {}, [0]);
-        Plotly.update("plotAfreq", {x:[x_data.freq], y:[freq_data.A]}, {}, [0]);
+        Plotly.update("plotAtime", {x:[frame.time, frame.time, frame.time],
+                                    y:[frame.A, frame.A_min, frame.A_max]}, {}, [0,1,2]);
+        Plotly.update("plotAfreq", {x:[frame.freq], y:[frame.psd_A]}, {}, [0]);
     }
     if (document.getElementById('B-enable').checked) {
-        Plotly.update("plotBtime", {x:[x_data.time], y:[time_data.B]}, {}, [0]);
-        Plotly.update("plotBfreq", {x:[x_data.freq], y:[freq_data.B]}, {}, [0]);
+        Plotly.update("plotBtime", {x:[frame.time, frame.time, frame.time],
+                                    y:[frame.B, frame.B_min, frame.B_max]}, {}, [0,1,2]);
+        Plotly.update("plotBfreq", {x:[frame.freq], y:[frame.psd_B]}, {}, [0]);
+    }
+}
+async function open_file() {
+    disable(true);
+    try {
+        replay = await eel.py_from_file(document.getElementById('replay-path').value)();
+        // don't hold the controls while the overview fills in
+        replay_window(0, replay.duration).catch(error => console.log('Could not replay file: ', error));
+    } catch (error) {
+        console.log('Could not open file: ', error);
+        replay = null;
+    }
+    disable(false);
+}
+async function replay_window(t0, t1) {
+    // the file's overview is built in the background, so ask again until this window is complete
+    // (unless another window was asked for in the meantime)
+    let file = replay;
+    file.window = [t0, t1];
+    while (true) {
+        let frame = await decode_arrays(await eel.py_replay_window(t0, t1, MAX_REPLAY_BINS)());
+        if (replay !== file || file.window[0] !== t0 || file.window[1] !== t1) {
+            return;
+        }
+        draw_frame(frame);
+        if (frame.complete) {
+            return;
+        }
+        await sleep(REPLAY_POLL_INTERVAL);
+    }
+}
+function on_time_relayout(event) {
+    // zooming or panning a time plot while replaying reads just that window from the file
+    if (!replay || running_flag) {
+        return;
+    }
+    if (event['xaxis.range[0]'] !== undefined) {
+        replay_window(event['xaxis.range[0]'], event['xaxis.range[1]']);
+    } else if (event['xaxis.autorange']) {
+        replay_window(0, replay.duration);
     }
 }
 async function get_psd_integral() {
@@ -147,6 +246,7 @@ async function live() {
         }
 
         running_flag = true;
+        replay = null;
         stop_flag = false;
         
         await pico_set_channels();
@@ -155,16 +255,37 @@ async function live() {
         let stream_duration = 60*60*24; // run for 1 day
         let dt = 1/get_float('live-fs'); // 1 ms per point
         
-        dt = await eel.py_pico_stream_setup(stream_duration, buffer_duration, dt)(); // pico will update dt
+        if (document.getElementById('live-record').checked) {
+            // python opens the files when the stream is set up, so nothing is missed
+            await eel.py_start_recording(document.getElementById('selected-directory').innerText,
+                                         document.getElementById('file-suffix').value)();
+        }
+        let downsample = Math.max(get_int('live-downsample') || 1, 1);
+        dt = await eel.py_pico_stream_setup(stream_duration, buffer_duration, dt, downsample)(); // pico will update dt
         
         document.getElementById('live-fs').value = 1/dt
         document.getElementById('live-tab').classList.add('pulsing');
         
+        // python pushes frames to js_on_frame from here on, this loop only watches the status
+        latest_frame = null;
+        pending_overflow = false;
+        push_error = null;
+        await eel.py_start_push(get_int('binsize') || 1)(); // at python's push_fps from default.json
+        
         let num_warn = 0;
         let last_warn = 0;
+        let last_spec = 0;
         while (running_flag) {
-            let overflow = await eel.py_pico_stream_to_buff()();
-            if (overflow) {
+            await sleep(50);
+            if (push_error !== null) {
+                throw new Error('Live frames stopped: ' + push_error);
+            }
+            if (document.getElementById('waterfall-enable').checked && Date.now() - last_spec > SPEC_INTERVAL) {
+                last_spec = Date.now();
+                await draw_spectrogram();
+            }
+            if (pending_overflow) {
+                pending_overflow = false;
                 document.getElementById('live-btn').classList.remove('btn-primary')
                 document.getElementById('live-btn').classList.add('btn-danger')
                 num_warn += 1;
@@ -176,15 +297,15 @@ async function live() {
                 document.getElementById('live-btn').classList.remove('btn-danger')
             }
             
-            await plot();
-            
-            if (! await eel.py_pico_is_streaming()()) {
+            if (latest_frame && !latest_frame.streaming) {
                 // restart stream
                 console.log('Restarting live streaming')
-                await eel.py_pico_stream_setup(stream_duration, buffer_duration, dt)();
+                latest_frame = null;
+                await eel.py_pico_stream_setup(stream_duration, buffer_duration, dt, downsample)();
             }
             
             if (stop_flag) {
+                await eel.py_stop_push()();
                 await pico_stop();
                 break;
             }
@@ -192,10 +313,30 @@ async function live() {
         running_flag = false;
     } catch (error) {
         console.log(error);
+        await eel.py_stop_push()();
+        await eel.py_stop_recording()();
         await pico_reconnect();
     }
     disable(false);
 }
+eel.expose(js_on_frame);
+async function js_on_frame(frame) {
+    // frames pushed by python during live(). Acking asks for the next one, python drops frames
+    // while we are still busy with this one.
+    if (frame.error !== undefined) {
+        push_error = frame.error; // python stopped pushing, live() gives up on its next check
+        return;
+    }
+    let frame_id = frame.id;
+    try {
+        frame = await decode_arrays(frame);
+        draw_frame(frame);
+        pending_overflow = pending_overflow || frame.overflow;
+        latest_frame = frame;
+    } finally {
+        eel.py_frame_ack(frame_id, axes.version);
+    }
+}
 async function single() {
     disable(true);
     document.getElementById('live-btn').classList.add('btn-primary')
@@ -208,6 +349,7 @@ async function single() {
         }
         
         running_flag = true;
+        replay = null;
         stop_flag = false;
         
         await pico_set_channels();
@@ -215,8 +357,18 @@ async function single() {
         let buffer_duration = get_float('single-window'); // window size
         let stream_duration = buffer_duration; // make stream time the same as the buffer size
         let dt = 1/get_float('single-fs'); // time between points. Can't rely on this to be the real dt because pico does type casting, but it will be close.
+        let to_disk = document.getElementById('single-todisk').checked;
         
-        dt = await eel.py_pico_stream_setup(stream_duration, buffer_duration, dt)(); // pico will update dt
+        if (to_disk) {
+            // the duration is only bounded by disk space, so just keep a modest window in memory for plotting
+            let dir = document.getElementById('selected-directory').innerText
+            let suffix = document.getElementById('file-suffix').value
+            let res = await eel.py_pico_stream_to_disk(dir, suffix, stream_duration, Math.min(buffer_duration, 10), dt)();
+            dt = res[0]; // pico will update dt
+            console.log('Streaming to disk: ' + res[1])
+        } else {
+            dt = await eel.py_pico_stream_setup(stream_duration, buffer_duration, dt)(); // pico will update dt
+        }
         
         document.getElementById('single-fs').value = 1/dt
         
@@ -229,6 +381,8 @@ async function single() {
         let num_warn = 0;
         
         while (running_flag) {
+            // the acquisition thread does the work, this only checks on it
+            await sleep(SINGLE_POLL_INTERVAL);
             let overflow = await eel.py_pico_stream_to_buff()();
             if (overflow) {
                 num_warn += 1;
@@ -247,7 +401,7 @@ async function single() {
             }
         }
         
-        if ( document.getElementById('single-autosave').checked ) {
+        if ( document.getElementById('single-autosave').checked && !to_disk ) {
             await save_buff(1);
         }
         
@@ -265,6 +419,15 @@ async function single() {
 // Initialize pico, plots
 var running_flag = false;
 var stop_flag = false;
+var latest_frame = null; // newest frame pushed by python in live mode
+var axes = {version: null, time: [], freq: []}; // time/freq axes, cached until python says they changed
+var pending_overflow = false;
+var push_error = null; // set by js_on_frame if python could not make a frame
+const SPEC_INTERVAL = 500; // ms between waterfall refreshes in live mode
+const SINGLE_POLL_INTERVAL = 100; // ms between status checks during a single capture
+var replay = null; // info on the file opened by open_file, until the next acquisition
+const MAX_REPLAY_BINS = 4000;
+const REPLAY_POLL_INTERVAL = 300; // ms between requests while a replay window is still being summarized
 
 var layout_time = {
     margin: {
@@ -294,11 +457,34 @@ var data_A = {x:[], y:[],
 var data_B = {x:[], y:[],
     mode: 'lines', 
     marker:{color:'red'}};
+// min/max envelope of each bin, shaded between the two traces
+var env_A = [{x:[], y:[], mode:'lines', line:{width:0}, hoverinfo:'skip', showlegend:false},
+             {x:[], y:[], mode:'lines', line:{width:0}, hoverinfo:'skip', showlegend:false,
+              fill:'tonexty', fillcolor:'rgba(31,119,180,0.3)'}];
+var env_B = [{x:[], y:[], mode:'lines', line:{width:0}, hoverinfo:'skip', showlegend:false},
+             {x:[], y:[], mode:'lines', line:{width:0}, hoverinfo:'skip', showlegend:false,
+              fill:'tonexty', fillcolor:'rgba(255,0,0,0.3)'}];
+
+var layout_spec = {
+    margin: {
+        l: 50,
+        r: 20,
+        b: 50,
+        t: 20,
+        pad: 5
+    }, title: false,
+    xaxis: {title: {text: 'freq (Hz)'}},
+    yaxis: {title: {text: 'time (s)'}}
+};
 
-Plotly.newPlot('plotAtime', [data_A], layout_time);
+Plotly.newPlot('plotAtime', [data_A].concat(env_A), layout_time);
 Plotly.newPlot('plotAfreq', [data_A], layout_freq);
-Plotly.newPlot('plotBtime', [data_B], layout_time);
+Plotly.newPlot('plotBtime', [data_B].concat(env_B), layout_time);
 Plotly.newPlot('plotBfreq', [data_B], layout_freq);
+document.getElementById('plotAtime').on('plotly_relayout', on_time_relayout);
+document.getElementById('plotBtime').on('plotly_relayout', on_time_relayout);
+Plotly.newPlot('plotAspec', [], layout_spec);
+Plotly.newPlot('plotBspec', [], layout_spec);
 
 document.getElementById('PSDscale').addEventListener('change', function() {
     var scale = this.value;
@@ -310,6 +496,15 @@ document.getElementById('PSDscale').addEventListener('change', function() {
     });
 });
 
+function set_psd_options() {
+    eel.py_set_psd_options({
+        window: document.getElementById('psd-window').value,
+        averaging: document.getElementById('psd-averaging').value
+    });
+}
+document.getElementById('psd-window').addEventListener('change', set_psd_options);
+document.getElementById('psd-averaging').addEventListener('change', set_psd_options);
+
 // For selecting an output directory. Initialize dialog_window, event listener
 var dialog_window = null;
 window.addEventListener('message', function(event) {
@@ -327,6 +522,8 @@ document.getElementById('binsize').addEventListener('blur', function(event) {
     }
     if (!running_flag) {
         plot();
+    } else {
+        eel.py_set_push_binsize(get_int('binsize'));
     }
 });
 document.getElementById('live-fs').addEventListener('blur', function(event) {
@@ -369,7 +566,8 @@ document.getElementById('single-window').addEventListener('blur', function(event
     let el = document.getElementById('single-window');
     if (!window || window < parseFloat(el.min)) {
         el.value = 1;
-    } else if (window > parseFloat(el.max)) {
+    } else if (window > parseFloat(el.max) && !document.getElementById('single-todisk').checked) {
+        // streaming to disk is not bounded by memory
         el.value = parseFloat(el.max);
     }
 });